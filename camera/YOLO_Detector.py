@@ -16,7 +16,13 @@ import cv2
 import imutils
 import time
 import platform
+import math
+import queue
+import threading
 import numpy as np
+import preprocess
+import detectorBackends
+from concurrent.futures import ThreadPoolExecutor
 
 # decice tree for rk356x/rk3588
 DEVICE_COMPATIBLE_NODE = '/proc/device-tree/compatible'
@@ -25,33 +31,61 @@ class YOLO_Detector:
     '''
         This class intends to create an object detector based on the YOLOv3
         trained model. The model can run on a Linux based system, but also on a Rockchip 356X/3588
-        with NPU.
+        with NPU. Besides the torch model, the engines of detectorBackends
+        (RKNN, ONNX Runtime and OpenCV DNN) share the preprocessing and the
+        post process of this class.
 
         The code used in this library is based on
         https://www.codespeedy.com/yolo-object-detection-from-image-with-opencv-and-python/
         https://github.com/rockchip-linux/rknn-toolkit2
     '''
 
-    def __init__(self, path="ultralytics/yolov5", model="yolov5s", rknn_model="yolov5s.rknn"):
+    def __init__(self, path="ultralytics/yolov5", model="yolov5s", rknn_model="yolov5s.rknn", npu_cores=0,
+                 classes=("person",), backend="auto", onnx_model="yolov5s.onnx", threads=0):
         '''
              This routine creates the neural network for using as object detector.
+             On the NPU one runtime is created per core, and the images are
+             dispatched to the cores free (see inference).
 
              Args:
-                 None
+                 path (str): repository of the torch model
+                 model (str): name of the torch model
+                 rknn_model (str): path of the RKNN model
+                 npu_cores (int): NPU cores to use, 0 for all of them
+                 classes (list): names of the classes detected, the rest are
+                     discarded in the post process. None for all the classes
+                 backend (str): engine running the model, one of
+                     detectorBackends.BACKENDS. auto is rknn on the Rockchip
+                     with NPU and torch otherwise
+                 onnx_model (str): path of the ONNX model, for onnxruntime and
+                     opencv
+                 threads (int): threads of onnxruntime, 0 for all the cores
 
              Returns:
                  A class Detector
 
              Raises:
-                 None
+                 Exception: unknown class or backend
         '''
         # initialize attributes
         self.host = None
+        self.backend = None
         self.model = None
-        self.rknn_lite = None
+        self.runtimes = queue.Queue()
+        self.executor = None
+        # images detected at the same time, one per runtime
+        self.workers = 1
+        self.numPersons = 0
+        self.loadTime = 0.0
+        self.warmupTime = 0.0
         self.IMG_SIZE = 640
         self.BOX_THESH = 0.5
         self.NMS_THRESH = 0.6
+        # objectness threshold before the sigmoid, see process()
+        self.obj_logit = np.log(self.BOX_THESH / (1 - self.BOX_THESH))
+        self._grids = {}
+        self._letterboxes = {}
+        self._local = threading.local()
         self.CLASSES = ("person", "bicycle", "car", "motorbike ", "aeroplane ", "bus ", "train", "truck ", "boat", "traffic light",
            "fire hydrant", "stop sign ", "parking meter", "bench", "bird", "cat", "dog ", "horse ", "sheep", "cow", "elephant",
            "bear", "zebra ", "giraffe", "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee", "skis", "snowboard", "sports ball", "kite",
@@ -60,58 +94,97 @@ class YOLO_Detector:
            "pottedplant", "bed", "diningtable", "toilet ", "tvmonitor", "laptop ", "mouse   ", "remote ", "keyboard ", "cell phone", "microwave ",
            "oven ", "toaster", "sink", "refrigerator ", "book", "clock", "vase", "scissors ", "teddy bear ", "hair drier", "toothbrush ")
 
+        # indexes of the classes detected
+        names = [name.strip() for name in self.CLASSES]
+        if classes is None:
+            classes = names
+        for name in classes:
+            if name not in names:
+                raise Exception(f"Unknown class {name}")
+        self.class_ids = np.array([i for i, name in enumerate(names) if name in classes])
+
 
         # machine in order to use NPU if available
+        start = time.time()
         self.host = self.get_host()
         print(f"Host: {self.host}")
         
+        if backend == 'auto':
+            backend = 'rknn' if self.host == 'RK3588' or self.host == 'RK356x' else 'torch'
+        if backend not in detectorBackends.BACKENDS:
+            raise Exception(f"Unknown backend {backend}")
+        self.backend = backend
+
         # if the machine is a rockchip with NPU, in particular
         # a RK3588 or RK356X
-        if self.host == 'RK3588' or self.host == 'RK356x':
+        if backend == 'rknn':
             try:
                 from rknnlite.api import RKNNLite
             except ImportError as e:
                 raise Exception(f"Error: {e}")
-            
-            try:
-                
-                self.rknn_lite = RKNNLite()
-
-                # load RKNN model
-                print('--> Load RKNN model')
-                ret = self.rknn_lite.load_rknn(rknn_model)
-                if ret != 0:
-                    raise Exception(f"Error loading the RKNN model. Error {ret}")
-                print('done')
-
-                # init runtime environment
-                print('--> Init runtime environment')
-                # run on RK356x/RK3588 with Debian OS, do not need specify target.
-                if self.host == 'RK3588':
-                    ret = self.rknn_lite.init_runtime(core_mask=RKNNLite.NPU_CORE_0)
-                else:
-                    ret = self.rknn_lite.init_runtime()
-                if ret != 0:
-                    raise Exception(f"Init runtime environment failed. Error {ret}")
-                print('done')
-            except Exception as e:
-                print("CAgondios")
-                raise Exception(e)
-                
-            print(f"(YOLO_Detector) YOLO loaded in NPU of {self.host}")
-        
-        # else in CPU   
+
+            # one runtime per core, the RK356x has a single core
+            if self.host == 'RK3588':
+                cores = [RKNNLite.NPU_CORE_0, RKNNLite.NPU_CORE_1, RKNNLite.NPU_CORE_2]
+            else:
+                cores = [None]
+            if npu_cores > 0:
+                cores = cores[:npu_cores]
+            runtimes = [detectorBackends.RKNNBackend(rknn_model, core) for core in cores]
+
+        # ONNX model on CPU, one runtime that uses the cores itself
+        elif backend == 'onnxruntime':
+            runtimes = [detectorBackends.ONNXRuntimeBackend(onnx_model, threads)]
+        elif backend == 'opencv':
+            runtimes = [detectorBackends.OpenCVBackend(onnx_model)]
+
+        # else torch in CPU
         else:
-        
             try:
-            
+
                 import torch
-                
+
                 # Pytorch model
                 self.model = torch.hub.load(path, model)
-                print("(YOLO_Detector) YOLO loaded")
+                # the model discards the other classes in its own NMS
+                self.model.classes = self.class_ids.tolist()
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="torch")
+                self.loadTime = time.time() - start
+                print(f"(YOLO_Detector) YOLO loaded in {self.loadTime:.1f}s")
             except Exception as e:
                 raise Exception(e)
+            return
+
+        # the images are preprocessed, inferred and postprocessed on
+        # a thread per runtime, so the stages of different images overlap
+        for runtime in runtimes:
+            self.runtimes.put(runtime)
+        self.workers = len(runtimes)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=backend)
+        self.loadTime = time.time() - start
+        print(f"(YOLO_Detector) YOLO loaded in {len(runtimes)} {backend} runtimes on {self.host} in {self.loadTime:.1f}s")
+
+    def warmup(self):
+        '''
+            This routine runs a blank image through every runtime, so that
+            the first frames do not pay for the lazy initializations of the
+            engines (memory allocation, kernels selection, ...).
+
+            Args:
+                None
+
+            Returns:
+                seconds taken
+
+            Raises:
+                None
+        '''
+        start = time.time()
+        blank = np.zeros((self.IMG_SIZE, self.IMG_SIZE, 3), dtype=np.uint8)
+        self.detect_batch([blank] * self.workers, letterboxes=[(1.0, 0, 0)] * self.workers)
+        self.numPersons = 0
+        self.warmupTime = time.time() - start
+        return self.warmupTime
 
     def getPersons(self):
         
@@ -130,86 +203,410 @@ class YOLO_Detector:
         '''
         return self.numPersons
 
-    def detect(self, img, confidence=0.65):
+    def detect(self, img, confidence=0.65, letterbox=None):
+        '''
+            This routine detects the objects of the classes wanted in the image.
+
+            Args:
+                img (ndarray): BGR image, or the RGB image already letterboxed
+                    to IMG_SIZE if letterbox is given (e.g. the yolo plane of SHMCAM)
+                confidence (float): minimum confidence of the objects returned
+                letterbox (tuple): (scale, padX, padY) used to letterbox img, see
+                    preprocess.letterboxParams()
+
+            Returns:
+                list of boxes in the form [ [x, y, w, h], label, confidence, color, class_id ]
+                in coordinates of the original image
+
+            Raises:
+                None
+        '''
+        return self.detect_batch([img], confidence, [letterbox])[0]
+
+    def detect_batch(self, images, confidence=0.65, letterboxes=None):
+        '''
+            This routine detects the objects in several images at once, e.g.
+            the latest frames of several cameras. With torch the images run
+            as one batch through the model. With the other backends they are
+            spread over the runtimes (the cores of the NPU), as the models
+            are built for a batch of one.
+
+            Args:
+                images (list): images, as in detect()
+                confidence (float): minimum confidence of the objects returned
+                letterboxes (list): letterbox of each image, as in detect(), or
+                    None if no image is letterboxed
+
+            Returns:
+                list with the boxes of each image, as returned by detect()
+
+            Raises:
+                None
+        '''
+        if letterboxes is None:
+            letterboxes = [None] * len(images)
+
+        if self.model is None:
+            # the results are collected in the order of the images
+            futures = [self.submit(img, confidence, letterbox) for img, letterbox in zip(images, letterboxes)]
+            ret = [future.result() for future in futures]
+
+        # else torch, on its single thread as the model is not thread safe
+        else:
+            ret = self.executor.submit(self.detect_torch, images, confidence, letterboxes).result()
+
+        self.numPersons = sum(1 for boxes in ret for box in boxes if box[1] == 'person')
+        return ret
+
+    def detect_regions(self, img, regions, confidence=0.65):
+        '''
+            This routine detects the objects in regions of a high resolution
+            image (see regions()). The regions are cropped without copying,
+            run as one batch, and their boxes are merged with an NMS across
+            regions, so an object seen by two overlapping regions is
+            returned once.
+
+            Args:
+                img (ndarray): BGR image
+                regions (list): regions (x, y, w, h) of the image, in pixels
+                confidence (float): minimum confidence of the objects returned
+
+            Returns:
+                list of boxes, as returned by detect(), in coordinates of img
+
+            Raises:
+                None
+        '''
+        crops = [img[y:y + h, x:x + w] for x, y, w, h in regions]
+        boxes = []
+        for (x, y, w, h), found in zip(regions, self.detect_batch(crops, confidence)):
+            for box in found:
+                box[0] = [box[0][0] + x, box[0][1] + y, box[0][2], box[0][3]]
+                boxes.append(box)
+        if len(regions) < 2 or not boxes:
+            return boxes
+
+        xyxy = np.array([[b[0][0], b[0][1], b[0][0] + b[0][2], b[0][1] + b[0][3]] for b in boxes], dtype=np.float32)
+        keep = self.nms_boxes(xyxy, np.array([b[4] for b in boxes]), np.array([b[2] for b in boxes]))
+        ret = [boxes[i] for i in sorted(keep)]
+        self.numPersons = sum(1 for box in ret if box[1] == 'person')
+        return ret
+
+    def regions(self, width, height, rois=None, tiled=False, overlap=0.2, full_frame=True):
+        '''
+            This routine gets the regions of an image to detect on with
+            detect_regions(). Each region of interest is detected as a whole,
+            or split into overlapping tiles of IMG_SIZE so that the model sees
+            it at full resolution.
+
+            Args:
+                width (int): width of the image
+                height (int): height of the image
+                rois (list): regions of interest (x, y, w, h) relative to the
+                    image size (0 to 1), the whole image if None or empty
+                tiled (bool): split the regions into tiles
+                overlap (float): fraction of a tile overlapping the next one
+                full_frame (bool): with tiles, detect also on each whole
+                    region of interest (the whole image if no roi is given),
+                    for the objects bigger than a tile
+
+            Returns:
+                list of regions (x, y, w, h) in pixels
+
+            Raises:
+                None
+        '''
+        if not rois:
+            rois = [(0.0, 0.0, 1.0, 1.0)]
+
+        regions = []
+        for rx, ry, rw, rh in rois:
+            x, y = int(rx * width), int(ry * height)
+            w, h = min(int(rw * width), width - x), min(int(rh * height), height - y)
+            if not tiled:
+                regions.append((x, y, w, h))
+                continue
+            for ty in self.tile_offsets(h, overlap):
+                for tx in self.tile_offsets(w, overlap):
+                    regions.append((x + tx, y + ty, min(self.IMG_SIZE, w), min(self.IMG_SIZE, h)))
+            # a region of a single tile is already detected as a whole
+            if full_frame and (w > self.IMG_SIZE or h > self.IMG_SIZE):
+                regions.append((x, y, w, h))
+
+        return regions
+
+    def tile_offsets(self, length, overlap):
+        '''
+            This routine gets the offsets of the tiles of IMG_SIZE covering a
+            length, evenly spread and overlapping at least by overlap.
+
+            Args:
+                length (int): length to cover
+                overlap (float): fraction of a tile overlapping the next one
+
+            Returns:
+                list of offsets
+
+            Raises:
+                None
+        '''
+        if length <= self.IMG_SIZE:
+            return [0]
+        step = self.IMG_SIZE * (1 - overlap)
+        n = math.ceil((length - self.IMG_SIZE) / step) + 1
+        return [round(i * (length - self.IMG_SIZE) / (n - 1)) for i in range(n)]
+
+    def submit(self, img, confidence=0.65, letterbox=None):
+        '''
+            This routine queues the image for detection and returns at once,
+            so that the next images can be read meanwhile. The images are
+            dispatched to the runtimes free, and the futures are to be
+            collected in the order submitted. getPersons() is not updated.
+
+            Args:
+                img (ndarray): image, as in detect(). It must not change until
+                    the detection is done
+                confidence (float): minimum confidence of the objects returned
+                letterbox (tuple): letterbox of the image, as in detect()
+
+            Returns:
+                concurrent.futures.Future with the boxes, as returned by detect()
+
+            Raises:
+                None
+        '''
+        if self.model is None:
+            return self.executor.submit(self.detect_model, img, confidence, letterbox)
+        return self.executor.submit(lambda: self.detect_torch([img], confidence, [letterbox])[0])
+
+    def mapping(self, img, letterbox):
+        '''
+            This routine gets how the boxes in the model input map to the
+            original image: a box (x, y) in the model input is
+            ((x - pad_x) * ratio_x, (y - pad_y) * ratio_y).
+
+            Args:
+                img (ndarray): image, as in detect()
+                letterbox (tuple): letterbox of the image, as in detect()
+
+            Returns:
+                tuple (ratio_x, ratio_y, pad_x, pad_y)
+
+            Raises:
+                None
+        '''
+        if letterbox is None:
+            # the torch model letterboxes and maps the boxes back itself
+            if self.model is not None:
+                return 1.0, 1.0, 0, 0
+            letterbox = self.letterbox_params(img.shape)
+        return 1 / letterbox[0], 1 / letterbox[0], letterbox[1], letterbox[2]
+
+    def letterbox_params(self, shape):
+        '''
+            This routine gets how an image of the given shape is letterboxed
+            into the model input. It is computed once per shape.
+
+            Args:
+                shape (tuple): shape of the image
+
+            Returns:
+                tuple (scale, padX, padY), see preprocess.letterboxParams()
+
+            Raises:
+                None
+        '''
+        key = shape[:2]
+        if key not in self._letterboxes:
+            self._letterboxes[key] = preprocess.letterboxParams(shape[1], shape[0], self.IMG_SIZE)[:3]
+        return self._letterboxes[key]
+
+    def detect_torch(self, images, confidence, letterboxes):
+        '''
+            This routine detects the objects in the images with the torch
+            model, all of them in one batch.
+
+            Args:
+                images (list): images, as in detect()
+                confidence (float): minimum confidence of the objects returned
+                letterboxes (list): letterbox of each image, as in detect()
+
+            Returns:
+                list with the boxes of each image, as returned by detect()
+
+            Raises:
+                None
+        '''
+        # the model works on RGB images
+        frames = [img if letterbox is not None else img[..., ::-1] for img, letterbox in zip(images, letterboxes)]
+        results = self.model(frames)
         ret = []
-        color = 2128
-        self.numPersons = 0
-        ratio_x = 0.0
-        ratio_y = 0.0
+        # each detection is a row x1, y1, x2, y2, confidence, class
+        for detections, img, letterbox in zip(results.xyxy, images, letterboxes):
+            detections = detections.cpu().numpy()
+            ret.append(self.make_boxes(detections[:, :4], detections[:, 5].astype(np.int64), detections[:, 4],
+                                       confidence, self.mapping(img, letterbox)))
+        return ret
 
+    def detect_model(self, img, confidence, letterbox):
+        '''
+            This routine detects the objects in the image with a runtime of
+            the backend. It runs on the threads of the executor.
 
-        if self.host == 'RK3588' or self.host == 'RK356x':
-        
-            # Set inputs
-            # img, ratio, (dw, dh) = letterbox(img, new_shape=(IMG_SIZE, IMG_SIZE))
-            try:
+            Args:
+                img (ndarray): image, as in detect()
+                confidence (float): minimum confidence of the objects returned
+                letterbox (tuple): letterbox of the image, as in detect()
+
+            Returns:
+                list of boxes, as returned by detect()
+
+            Raises:
+                None
+        '''
+        boxes, classes, scores = self.inference(img, letterbox)
+        return self.make_boxes(boxes, classes, scores, confidence, self.mapping(img, letterbox))
+
+    def inference(self, img, letterbox=None):
+        '''
+            This routine runs the image through the model on the first
+            runtime free, and post processes its outputs.
+
+            Args:
+                img (ndarray): image, as in detect()
+                letterbox (tuple): letterbox of the image, as in detect()
+
+            Returns:
+                tuple (boxes, classes, scores) with the boxes as x1, y1, x2, y2
+                in the model input
+
+            Raises:
+                None
+        '''
+        # Set inputs. The BGR images are letterboxed (keeping the aspect
+        # ratio) into a buffer of the thread, reused for every image
+        try:
+            if letterbox is not None:
                 frame = img
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frame = cv2.resize(frame, (self.IMG_SIZE, self.IMG_SIZE))
-                ratio_x = img.shape[1] / frame.shape[1]
-                ratio_y = img.shape[0] / frame.shape[0]
-            except Exception as e:
-                print(f"Error resizing image for the object detection model")
+            else:
+                if not hasattr(self._local, 'frame'):
+                    self._local.preprocessor = preprocess.Preprocessor()
+                    self._local.frame = np.empty((self.IMG_SIZE, self.IMG_SIZE, 3), dtype=np.uint8)
+                frame = self._local.frame
+                self._local.preprocessor.letterbox(img, frame)
+        except Exception as e:
+            print(f"Error resizing image for the object detection model")
+            return self.no_objects()
+
+        # Inference on the first runtime free, the post process runs while
+        # the runtime takes the next image
+        runtime = self.runtimes.get()
+        try:
+            outputs = runtime.inference(frame)
+        except Exception as e:
+            print(f"Error while inference - {e}")
+            return self.no_objects()
+        finally:
+            self.runtimes.put(runtime)
+
+        try:
+
+            # model exported with the decoded boxes, e.g. ONNX of ultralytics
+            if len(outputs) == 1:
+                return self.decoded_post_process(outputs[0])
+
+            # post process of the three heads
+            input0_data = outputs[0]
+            input1_data = outputs[1]
+            input2_data = outputs[2]
+
+            input0_data = input0_data.reshape([3, -1]+list(input0_data.shape[-2:]))
+            input1_data = input1_data.reshape([3, -1]+list(input1_data.shape[-2:]))
+            input2_data = input2_data.reshape([3, -1]+list(input2_data.shape[-2:]))
+
+            input_data = list()
+            input_data.append(np.transpose(input0_data, (2, 3, 0, 1)))
+            input_data.append(np.transpose(input1_data, (2, 3, 0, 1)))
+            input_data.append(np.transpose(input2_data, (2, 3, 0, 1)))
+
+            return self.yolov5_post_process(input_data)
+
+        except Exception as e:
+            print(f"Error {e}")
+            return self.no_objects()
+
+    def no_objects(self):
+        '''
+            This routine gets the result of the post process when there is
+            no object, as empty arrays so that it is handled as any other.
 
-            try:
-                # Inference
-                outputs = self.rknn_lite.inference(inputs=[frame])
-            except Exception as e:
-                print(f"Error while inference - {e}")
-                
-            try:
+            Args:
+                None
 
-                # post process
-                input0_data = outputs[0]
-                input1_data = outputs[1]
-                input2_data = outputs[2]
-
-                input0_data = input0_data.reshape([3, -1]+list(input0_data.shape[-2:]))
-                input1_data = input1_data.reshape([3, -1]+list(input1_data.shape[-2:]))
-                input2_data = input2_data.reshape([3, -1]+list(input2_data.shape[-2:]))
-
-                input_data = list()
-                input_data.append(np.transpose(input0_data, (2, 3, 0, 1)))
-                input_data.append(np.transpose(input1_data, (2, 3, 0, 1)))
-                input_data.append(np.transpose(input2_data, (2, 3, 0, 1)))
-
-                boxes, classes, scores = self.yolov5_post_process(input_data)
-                for i in range(len(boxes)):
-                    if scores[i] > confidence:
-                        if self.CLASSES[classes[i]]  == 'person':
-                            ret.append([
-                                [round(boxes[i][0]*ratio_x),
-                          round( boxes[i][1]*ratio_y ),
-                             round( ratio_x*(boxes[i][2]-boxes[i][0]) ),
-                             round( ratio_y*(boxes[i][3]-boxes[i][1]) )],
-                            self.CLASSES[classes[i]],
-                            round(scores[i], 2),
-                            color
-                        ])
-                        self.numPersons += 1
-                        
-            except Exception as e:
-                print(f"Error {e}")
-        
-        # else in CPU
-        else:        
-            results = self.model(img)
-            p = results.pandas().xyxy[0]
-            for i in range(len(p)):
-                if p['confidence'][i] > confidence:
-                    if p['name'][i] == 'person':
-                        ret.append([
-                            [round(p['xmin'][i]),
-                             round(p['ymin'][i]),
-                             round(p['xmax'][i]-p['xmin'][i]),
-                             round(p['ymax'][i]-p['ymin'][i])],
-                            p['name'][i],
-                            round(p['confidence'][i], 2),
-                            color
-                        ])
-                        self.numPersons += 1
+            Returns:
+                tuple (boxes, classes, scores) of empty arrays
+
+            Raises:
+                None
+        '''
+        return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    def make_boxes(self, boxes, classes, scores, confidence, mapping):
+        '''
+            This routine converts the objects detected of the classes wanted
+            to the boxes returned by detect(), in coordinates of the original
+            image.
+
+            Args:
+                boxes (ndarray): boxes as x1, y1, x2, y2 in the model input
+                classes (ndarray): class of each box
+                scores (ndarray): score of each box
+                confidence (float): minimum confidence of the boxes returned
+                mapping (tuple): (ratio_x, ratio_y, pad_x, pad_y) from the model
+                    input to the original image
+
+            Returns:
+                list of boxes, as returned by detect()
+
+            Raises:
+                None
+        '''
+        ret = []
+        if len(scores) == 0:
+            return ret
+        color = 2128
+        ratio_x, ratio_y, pad_x, pad_y = mapping
+        for i in np.nonzero((scores > confidence) & np.isin(classes, self.class_ids))[0]:
+            ret.append([
+                [round((boxes[i][0]-pad_x)*ratio_x),
+                 round((boxes[i][1]-pad_y)*ratio_y),
+                 round(ratio_x*(boxes[i][2]-boxes[i][0])),
+                 round(ratio_y*(boxes[i][3]-boxes[i][1]))],
+                self.CLASSES[int(classes[i])].strip(),
+                round(float(scores[i]), 2),
+                color,
+                int(classes[i])
+            ])
 
         return ret
+
+    def close(self):
+        '''
+            This routine stops the threads and releases the runtimes.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+        while not self.runtimes.empty():
+            self.runtimes.get().release()
         
     def get_host(self):
         # get platform and device type
@@ -245,94 +642,92 @@ class YOLO_Detector:
         y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
         return y
 
-    def process(self, input, mask, anchors):
-
-        anchors = [anchors[i] for i in mask]
-        grid_h, grid_w = map(int, input.shape[0:2])
-
-        box_confidence = self.sigmoid(input[..., 4])
-        box_confidence = np.expand_dims(box_confidence, axis=-1)
+    def grid(self, grid_h, grid_w, mask, anchors):
+        '''
+            This routine gets the grid of cell offsets, the anchors and the
+            stride of an output of the model. They only depend on the size of
+            the output, so they are computed once and cached.
 
-        box_class_probs = self.sigmoid(input[..., 5:])
+            Args:
+                grid_h (int): rows of the output
+                grid_w (int): columns of the output
+                mask (list): anchors of the output
+                anchors (list): all the anchors of the model
 
-        box_xy = self.sigmoid(input[..., :2])*2 - 0.5
+            Returns:
+                tuple (grid, anchors, stride), with grid of shape
+                (grid_h, grid_w, 3, 2) holding the (column, row) of each cell
+                and anchors of shape (3, 2)
 
-        col = np.tile(np.arange(0, grid_w), grid_w).reshape(-1, grid_w)
-        row = np.tile(np.arange(0, grid_h).reshape(-1, 1), grid_h)
-        col = col.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        row = row.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        grid = np.concatenate((col, row), axis=-1)
-        box_xy += grid
-        box_xy *= int(self.IMG_SIZE/grid_h)
+            Raises:
+                None
+        '''
+        key = (grid_h, grid_w, tuple(mask))
+        if key not in self._grids:
+            col, row = np.meshgrid(np.arange(grid_w), np.arange(grid_h))
+            grid = np.stack((col, row), axis=-1).reshape(grid_h, grid_w, 1, 2).repeat(len(mask), axis=-2)
+            self._grids[key] = (grid.astype(np.float32),
+                                np.array([anchors[i] for i in mask], dtype=np.float32),
+                                int(self.IMG_SIZE/grid_h))
+        return self._grids[key]
 
-        box_wh = pow(self.sigmoid(input[..., 2:4])*2, 2)
-        box_wh = box_wh * anchors
+    def process(self, input, mask, anchors):
+        '''
+            This routine decodes the boxes of an output of the model. Only
+            the cells with an objectness over BOX_THESH are decoded: the
+            sigmoid is monotonic, so the threshold is applied to the raw
+            output and the sigmoids are computed on the few cells left, and
+            only on the classes wanted (class_ids). It's
+            a bit different with origin yolov5 post process, the score is the
+            class probability, not multiplied by the objectness.
 
-        box = np.concatenate((box_xy, box_wh), axis=-1)
+            Args:
+                input (ndarray): output of the model (grid_h, grid_w, 3, 5 + classes)
+                mask (list): anchors of the output
+                anchors (list): all the anchors of the model
 
-        return box, box_confidence, box_class_probs
+            Returns:
+                tuple (boxes, classes, scores) with the boxes as x, y, w, h
+                (center and size)
 
-    def filter_boxes(self, boxes, box_confidences, box_class_probs):
-        """Filter boxes with box threshold. It's a bit different with origin yolov5 post process!
+            Raises:
+                None
+        '''
+        grid, anchor_wh, stride = self.grid(int(input.shape[0]), int(input.shape[1]), mask, anchors)
 
-        # Arguments
-            boxes: ndarray, boxes of objects.
-            box_confidences: ndarray, confidences of objects.
-            box_class_probs: ndarray, class_probs of objects.
+        pos = np.nonzero(input[..., 4] >= self.obj_logit)
+        candidates = input[pos]
 
-        # Returns
-            boxes: ndarray, filtered boxes.
-            classes: ndarray, classes for boxes.
-            scores: ndarray, scores for boxes.
-        """
-        box_classes = np.argmax(box_class_probs, axis=-1)
-        box_class_scores = np.max(box_class_probs, axis=-1)
-        pos = np.where(box_confidences[..., 0] >= self.BOX_THESH)
+        box_xy = (self.sigmoid(candidates[:, :2])*2 - 0.5 + grid[pos]) * stride
+        box_wh = pow(self.sigmoid(candidates[:, 2:4])*2, 2) * anchor_wh[pos[2]]
 
-        boxes = boxes[pos]
-        classes = box_classes[pos]
-        scores = box_class_scores[pos]
+        # only the channels of the classes wanted
+        class_logits = candidates[:, 5 + self.class_ids]
+        best = np.argmax(class_logits, axis=-1)
+        classes = self.class_ids[best]
+        scores = self.sigmoid(class_logits[np.arange(len(best)), best])
 
-        return boxes, classes, scores
+        return np.concatenate((box_xy, box_wh), axis=-1), classes, scores
 
-    def nms_boxes(self, boxes, scores):
-        """Suppress non-maximal boxes.
+    def nms_boxes(self, boxes, classes, scores):
+        """Suppress non-maximal boxes of the same class, all classes at once.
+        The boxes of each class are moved apart by an offset, so that boxes
+        of different classes never overlap.
 
         # Arguments
-            boxes: ndarray, boxes of objects.
+            boxes: ndarray, boxes of objects (x1, y1, x2, y2).
+            classes: ndarray, classes of objects.
             scores: ndarray, scores of objects.
 
         # Returns
             keep: ndarray, index of effective boxes.
         """
-        x = boxes[:, 0]
-        y = boxes[:, 1]
-        w = boxes[:, 2] - boxes[:, 0]
-        h = boxes[:, 3] - boxes[:, 1]
-
-        areas = w * h
-        order = scores.argsort()[::-1]
-
-        keep = []
-        while order.size > 0:
-            i = order[0]
-            keep.append(i)
-
-            xx1 = np.maximum(x[i], x[order[1:]])
-            yy1 = np.maximum(y[i], y[order[1:]])
-            xx2 = np.minimum(x[i] + w[i], x[order[1:]] + w[order[1:]])
-            yy2 = np.minimum(y[i] + h[i], y[order[1:]] + h[order[1:]])
-
-            w1 = np.maximum(0.0, xx2 - xx1 + 0.00001)
-            h1 = np.maximum(0.0, yy2 - yy1 + 0.00001)
-            inter = w1 * h1
-
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-            inds = np.where(ovr <= self.NMS_THRESH)[0]
-            order = order[inds + 1]
-        keep = np.array(keep)
-        return keep
-
+        offset = (classes * (boxes.max() + 1)).reshape(-1, 1)
+        x1y1 = boxes[:, :2] + offset
+        wh = boxes[:, 2:4] - boxes[:, :2]
+        keep = cv2.dnn.NMSBoxes(np.concatenate((x1y1, wh), axis=-1).astype(np.float32),
+                                scores.astype(np.float32), 0.0, self.NMS_THRESH)
+        return np.array(keep, dtype=np.int64).reshape(-1)
 
     def yolov5_post_process(self, input_data):
         masks = [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
@@ -342,36 +737,49 @@ class YOLO_Detector:
         boxes, classes, scores = [], [], []
         for input, mask in zip(input_data, masks):
             b, c, s = self.process(input, mask, anchors)
-            b, c, s = self.filter_boxes(b, c, s)
             boxes.append(b)
             classes.append(c)
             scores.append(s)
 
         boxes = np.concatenate(boxes)
+        if len(boxes) == 0:
+            return self.no_objects()
         boxes = self.xywh2xyxy(boxes)
         classes = np.concatenate(classes)
         scores = np.concatenate(scores)
 
-        nboxes, nclasses, nscores = [], [], []
-        for c in set(classes):
-            inds = np.where(classes == c)
-            b = boxes[inds]
-            c = classes[inds]
-            s = scores[inds]
+        keep = self.nms_boxes(boxes, classes, scores)
 
-            keep = self.nms_boxes(b, s)
+        return boxes[keep], classes[keep], scores[keep]
 
-            nboxes.append(b[keep])
-            nclasses.append(c[keep])
-            nscores.append(s[keep])
+    def decoded_post_process(self, output):
+        '''
+            This routine post processes the output of a model exported with
+            the boxes already decoded (1, boxes, 5 + classes), with the
+            sigmoids applied. As in process(), the score is the class
+            probability and only the classes wanted are considered.
 
-        if not nclasses and not nscores:
-#            return None, None, None
-            return [], [], []
+            Args:
+                output (ndarray): output of the model
+
+            Returns:
+                tuple (boxes, classes, scores) with the boxes as x1, y1, x2, y2
+                in the model input
+
+            Raises:
+                None
+        '''
+        output = output.reshape(-1, output.shape[-1])
+        candidates = output[output[:, 4] >= self.BOX_THESH]
+        if len(candidates) == 0:
+            return self.no_objects()
 
-        boxes = np.concatenate(nboxes)
-        classes = np.concatenate(nclasses)
-        scores = np.concatenate(nscores)
+        class_probs = candidates[:, 5 + self.class_ids]
+        best = np.argmax(class_probs, axis=-1)
+        classes = self.class_ids[best]
+        scores = class_probs[np.arange(len(best)), best]
+        boxes = self.xywh2xyxy(candidates[:, :4])
 
-        return boxes, classes, scores
+        keep = self.nms_boxes(boxes, classes, scores)
 
+        return boxes[keep], classes[keep], scores[keep]
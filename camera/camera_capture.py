@@ -17,9 +17,15 @@ import av
 import cv2
 import time
 import sys
+import os
+import errno
+import fcntl
+import stat
+import struct
 import shmcam
 import timeMetrics
 from configparser import ConfigParser
+import numpy as np
 from numpy import asarray
 import gi
 import threading
@@ -27,6 +33,306 @@ import threading
 from threading import Thread
 
 fps=25
+statsPeriod=60
+
+# When the source is lost it is reopened after a delay that doubles on every
+# failure, from RECONNECT_MIN_DELAY up to RECONNECT_MAX_DELAY seconds. Single
+# corrupt packets do not reconnect, unless MAX_DECODE_ERRORS come in a row.
+# Reads from the stream give up after STREAM_TIMEOUT seconds.
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+MAX_DECODE_ERRORS = 10
+STREAM_TIMEOUT = 10.0
+
+# Frames sent to the pipe in raw format are preceded by this header: magic,
+# sequence number, timestamp, height, width, channels and numpy dtype string.
+PIPE_HEADER = struct.Struct('<4sQdIII8s')
+PIPE_MAGIC = b'SHMF'
+PIPE_FORMATS = ('raw', 'rawvideo', 'mjpeg')
+PIPE_SIZE = 1 << 20
+PIPE_RETRY_PERIOD = 1.0
+F_SETPIPE_SZ = 1031
+
+class FramePacer:
+    '''
+        This class decides which of the decoded frames are published, to keep
+        a target frame rate without sleeping. The decoder runs continuously
+        so that no packets pile up in the socket, and the frames arriving
+        before the next deadline are dropped.
+    '''
+
+    def __init__(self, targetFps=0):
+        '''
+            This routine initializes the pacer.
+
+            Args:
+                targetFps (float): frames per second to publish, 0 for all frames
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.period = 1 / targetFps if targetFps > 0 else 0.0
+        self.nextDeadline = 0.0
+        self.published = 0
+        self.dropped = 0
+
+    def ready(self, now=None):
+        '''
+            This routine decides whether the frame decoded now is published.
+            A frame is published if it arrives less than half a period before
+            the deadline, then the deadline advances one period. If the
+            source fell behind more than one period, the deadline restarts
+            from now.
+
+            Args:
+                now (float): time of the frame, now if None
+
+            Returns:
+                True if the frame is to be published
+
+            Raises:
+                None
+        '''
+        if now is None:
+            now = time.time()
+
+        if now < self.nextDeadline - self.period / 2:
+            self.dropped += 1
+            return False
+
+        self.nextDeadline += self.period
+        if self.nextDeadline < now - self.period:
+            self.nextDeadline = now + self.period
+        self.published += 1
+        return True
+
+    def toString(self):
+        '''
+            This routine returns a string with the counters of the pacer.
+
+            Args:
+                None
+
+            Returns:
+                string with the published and dropped frames
+
+            Raises:
+                None
+        '''
+        return f"Frames published / dropped: {self.published} / {self.dropped}"
+
+class FramePipe:
+    '''
+        This class streams the published frames to a named pipe (FIFO), in
+        one of the formats:
+            raw: each frame is a PIPE_HEADER followed by the BGR pixels
+            rawvideo: only the BGR pixels, as read by ffmpeg -f rawvideo
+                -pix_fmt bgr24 -video_size WxH
+            mjpeg: JPEG images, as read by ffmpeg -f mjpeg
+        The pipe is written without blocking. A frame that does not fit is
+        finished on the next calls, and the frames arriving meanwhile are
+        dropped, so a slow reader never stalls the capture. The pipe is
+        opened when a reader is there, and reopened if the reader goes away.
+    '''
+
+    def __init__(self, name, format='raw', quality=80):
+        '''
+            This routine initializes the pipe and creates the FIFO.
+
+            Args:
+                name (str): path of the FIFO
+                format (str): one of PIPE_FORMATS
+                quality (int): quality of the JPEG images (mjpeg format)
+
+            Returns:
+                None
+
+            Raises:
+                Exception: unknown format
+        '''
+        if format not in PIPE_FORMATS:
+            raise Exception(f"Unknown pipe format {format}, expected one of {PIPE_FORMATS}")
+        self.name = name
+        self.format = format
+        self.quality = quality
+        self.fd = None
+        self.retryTime = 0.0
+        self.sent = 0
+        self.dropped = 0
+        self._pending = []
+        self._buffer = None
+
+        if os.path.exists(name) and not stat.S_ISFIFO(os.stat(name).st_mode):
+            os.remove(name)
+        if not os.path.exists(name):
+            os.mkfifo(name)
+
+    def _open(self):
+        '''
+            This routine opens the FIFO without blocking. It only succeeds
+            with a reader on the other side, so it is retried every
+            PIPE_RETRY_PERIOD seconds.
+
+            Args:
+                None
+
+            Returns:
+                True if the FIFO is open
+
+            Raises:
+                None
+        '''
+        if self.fd is not None:
+            return True
+        if time.time() < self.retryTime:
+            return False
+        self.retryTime = time.time() + PIPE_RETRY_PERIOD
+        try:
+            self.fd = os.open(self.name, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                logging.error(f"Error opening the pipe {self.name}: {str(e)}")
+            return False
+
+        # a bigger pipe holds whole frames, best effort (Linux only)
+        try:
+            fcntl.fcntl(self.fd, F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            pass
+        logging.info(f"Pipe {self.name} opened ({self.format})")
+        return True
+
+    def _closeFd(self):
+        '''
+            This routine closes the FIFO, discarding the frame being sent.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self._pending = []
+
+    def _flush(self):
+        '''
+            This routine writes as much of the pending frame as the pipe
+            takes, without blocking.
+
+            Args:
+                None
+
+            Returns:
+                True if nothing is pending anymore
+
+            Raises:
+                None
+        '''
+        while self._pending:
+            try:
+                written = os.writev(self.fd, self._pending)
+            except BlockingIOError:
+                return False
+            except BrokenPipeError:
+                logging.info(f"Reader of the pipe {self.name} gone")
+                self._closeFd()
+                return False
+
+            # drop the buffers written, and the part written of the next one
+            while self._pending and written >= len(self._pending[0]):
+                written -= len(self._pending[0])
+                self._pending.pop(0)
+            if self._pending:
+                self._pending[0] = self._pending[0][written:]
+        return True
+
+    def write(self, shm, seq):
+        '''
+            This routine sends the frame of the shared memory with the given
+            sequence number, or drops it if the previous one is still being
+            sent.
+
+            Args:
+                shm (SHMCAM): shared memory with the frame
+                seq (int): sequence number of the frame
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if not self._open():
+            return
+        if not self._flush():
+            self.dropped += 1
+            return
+
+        # the frame is copied out of the ring buffer, which is overwritten
+        # while the pipe is still sending it. The buffer is reused
+        if self._buffer is None or self._buffer.shape != shm.getPlaneShape():
+            self._buffer = np.empty(shm.getPlaneShape(), dtype=np.uint8)
+        frame = shm.getFrame(seq, out=self._buffer)
+        if frame is None:
+            self.dropped += 1
+            return
+        seq, timestamp, img = frame
+
+        if self.format == 'mjpeg':
+            ret, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ret:
+                self.dropped += 1
+                return
+            self._pending = [memoryview(jpeg).cast('B')]
+        else:
+            self._pending = [memoryview(img).cast('B')]
+            if self.format == 'raw':
+                header = PIPE_HEADER.pack(PIPE_MAGIC, seq, timestamp, img.shape[0], img.shape[1], img.shape[2],
+                                          img.dtype.str.encode())
+                self._pending.insert(0, memoryview(header))
+        self.sent += 1
+        self._flush()
+
+    def toString(self):
+        '''
+            This routine returns a string with the counters of the pipe.
+
+            Args:
+                None
+
+            Returns:
+                string with the sent and dropped frames
+
+            Raises:
+                None
+        '''
+        return f"Frames piped / dropped: {self.sent} / {self.dropped}"
+
+    def close(self):
+        '''
+            This routine closes and removes the FIFO.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._closeFd()
+        if os.path.exists(self.name):
+            os.remove(self.name)
 
 def config(filename='camera.ini', section='cam_addr'):
     '''
@@ -64,12 +370,410 @@ def isCameraIndex(path):
     assert isinstance(path, str)
     return path.isdigit()
 
+def openStream(path, cam_addr):
+    '''
+        This routine opens the video source with PyAV, applying the decode
+        settings of the [cam_addr] section of the camera ini:
+            decode_threads (int): decoding threads, 0 for automatic
+            decode_thread_type (str): AUTO, FRAME, SLICE or NONE
+            low_delay (bool): do not buffer packets nor frames
+            skip_frame (str): frames the decoder discards: DEFAULT, NONREF,
+                BIDIR, NONINTRA or NONKEY (only keyframes are decoded)
+            rtsp_transport (str): tcp or udp
+            buffer_size (int): size of the socket buffer in bytes
+            stream_timeout (float): seconds to wait for the source when
+                opening or reading, STREAM_TIMEOUT if not given
+        Settings not given keep the PyAV defaults.
+
+        Args:
+            path (str): path or address of the video source
+            cam_addr (dict): parameters of the [cam_addr] section
+
+        Returns:
+            tuple with the container and the video stream
+
+        Raises:
+            Exception: the source cannot be opened
+    '''
+    # options of the demuxer / protocol
+    options = {}
+    if "rtsp_transport" in cam_addr:
+        options["rtsp_transport"] = cam_addr["rtsp_transport"]
+    if "buffer_size" in cam_addr:
+        options["buffer_size"] = cam_addr["buffer_size"]
+    lowDelay = eval(cam_addr.get("low_delay", "False"))
+    if lowDelay:
+        options["fflags"] = "nobuffer"
+        options["max_delay"] = "0"
+
+    container = av.open(path, options=options, timeout=float(cam_addr.get("stream_timeout", STREAM_TIMEOUT)))
+    stream = container.streams.video[0]
+
+    # options of the decoder
+    codec = stream.codec_context
+    if "decode_threads" in cam_addr:
+        codec.thread_count = int(cam_addr["decode_threads"])
+    if "decode_thread_type" in cam_addr:
+        codec.thread_type = cam_addr["decode_thread_type"].upper()
+    if lowDelay:
+        codec.options = {"flags": "low_delay"}
+    if "skip_frame" in cam_addr:
+        codec.skip_frame = cam_addr["skip_frame"].upper()
+
+    logging.info(f"Stream opened with options {options}, threads {codec.thread_count} ({codec.thread_type}), "
+                 f"skip frame {codec.skip_frame}")
+    return container, stream
+
 
 pipe_name = 'video_pipe'
-pipeout = None
-nSamples = 0
-tAverage = 0.0
-tMax = 0.0
+
+class CameraCapture:
+    '''
+        This class captures the frames of one camera into its shared memory.
+        The work is done one frame at a time with step(), so that a single
+        process can serve several cameras (see camera_capture_service.py).
+    '''
+
+    def __init__(self, cam_addr):
+        '''
+            This routine initializes the capture of a camera and connects to
+            its shared memory.
+
+            Args:
+                cam_addr (dict): parameters of the [cam_addr] section of the camera ini
+
+            Returns:
+                None
+
+            Raises:
+                Exception: the shared memory does not exist
+        '''
+        self.cam_addr = cam_addr
+        self.path_video = cam_addr["camera_address"]
+        self.camera_id = cam_addr["camera_id"]
+        self.pipe_name = cam_addr.get("pipe_name", pipe_name)
+        self.pipe = None
+        self.cap = None
+        self.input_container = None
+        self.input_stream = None
+        self._decoder = None
+
+        # State of the connection to the source, see open(), disconnect()
+        self.connected = False
+        self.reconnectMinDelay = float(cam_addr.get("reconnect_min_delay", RECONNECT_MIN_DELAY))
+        self.reconnectMaxDelay = float(cam_addr.get("reconnect_max_delay", RECONNECT_MAX_DELAY))
+        self.reconnectDelay = self.reconnectMinDelay
+        self.reconnectTime = 0.0
+        self.decodeErrors = 0
+        self.waitKeyframe = True
+
+        # Frames are published at publish_fps, all of them if not given
+        self.pacer = FramePacer(float(cam_addr.get("publish_fps", 0)))
+        self.metrics = timeMetrics.timeMetrics()
+        self.statsTime = time.time() + statsPeriod
+
+        # Connect to the area of shared memory
+        logging.info(f"Connecting to shared memory with id: {self.camera_id}")
+        self.shm = shmcam.SHMCAM(create=False, name=self.camera_id)
+
+    def open(self):
+        '''
+            This routine connects to the source of video. The reason to use av is
+            to support RTSP services. AV also supports paths. However av, does not
+            support indexes for the cameras, at least in some computers.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                Exception: the source cannot be opened
+        '''
+        logging.info(f"Opening the video source {self.path_video}")
+        if isCameraIndex(self.path_video):
+            logging.info(f"Opening device index: {self.path_video}")
+            self.cap = cv2.VideoCapture(int(self.path_video))
+        else:
+            logging.info(f"Opening device path: {self.path_video}")
+            self.input_container, self.input_stream = openStream(self.path_video, self.cam_addr)
+            self._decoder = self.input_container.decode(self.input_stream)
+        if self.cap is not None and not self.cap.isOpened():
+            raise Exception(f"Device {self.path_video} cannot be opened")
+
+        # after (re)connecting the decoder has no reference frames
+        self.connected = True
+        self.decodeErrors = 0
+        self.waitKeyframe = True
+        self.shm.setStreamConnected(True)
+
+    def disconnect(self, reason):
+        '''
+            This routine closes the source of video after losing it, and
+            schedules the reconnection with exponential backoff.
+
+            Args:
+                reason (str): why the source is closed, for the log
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        logging.error(f"{self.camera_id}: source lost ({reason}), reconnecting in {self.reconnectDelay:.1f} s")
+        self.closeSource()
+        self.connected = False
+        self.shm.setStreamConnected(False)
+        self.reconnectTime = time.time() + self.reconnectDelay
+        self.reconnectDelay = min(self.reconnectDelay * 2, self.reconnectMaxDelay)
+
+    def reconnect(self):
+        '''
+            This routine opens the source of video once the backoff delay is
+            over. Until then it returns at once, the caller waits for
+            waitTime() before the next step, so that no thread is held.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if time.time() < self.reconnectTime:
+            return
+
+        # the first connection is not a reconnection
+        if self.reconnectTime > 0:
+            self.shm.countReconnect()
+        try:
+            self.open()
+        except Exception as e:
+            self.disconnect(str(e))
+
+    def waitTime(self):
+        '''
+            This routine gets how long to wait before the next step, the rest
+            of the backoff delay if the source is lost.
+
+            Args:
+                None
+
+            Returns:
+                seconds to wait, 0 if the next step can run now
+
+            Raises:
+                None
+        '''
+        if self.connected:
+            return 0.0
+        return max(0.0, self.reconnectTime - time.time())
+
+    def decodeError(self, error):
+        '''
+            This routine handles a frame that cannot be read or decoded. The
+            frames are discarded until the next keyframe, and the source is
+            reconnected if the errors go on.
+
+            Args:
+                error (str): description of the error, for the log
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.shm.countDecodeError()
+        self.decodeErrors += 1
+        if self.decodeErrors >= MAX_DECODE_ERRORS:
+            self.disconnect(f"{self.decodeErrors} errors in a row, last: {error}")
+            return
+
+        logging.warning(f"{self.camera_id}: decode error ({error}), waiting for a keyframe")
+        self.waitKeyframe = True
+        if self.input_container is not None:
+            # a generator is over once it raises, start a new one
+            self._decoder = self.input_container.decode(self.input_stream)
+
+    def frameDecoded(self):
+        '''
+            This routine records that the source delivered a good frame.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.shm.setLastFrameTime()
+        self.decodeErrors = 0
+        self.reconnectDelay = self.reconnectMinDelay
+
+    def step(self):
+        '''
+            This routine reads one frame from the source and publishes it if
+            capturing and due by the pacer.
+
+            Args:
+                None
+
+            Returns:
+                False if the module is requested to exit, True otherwise
+
+            Raises:
+                None
+        '''
+        self.metrics.newCycle()
+        flags = self.shm.getFlags()
+
+        # need to quit?
+        if flags & shmcam.FLAG_EXIT:
+            logging.info(f"Request received to exit module")
+            return False
+
+        # source lost, wait for the backoff and reopen it
+        if not self.connected:
+            self.reconnect()
+            return True
+
+        capturing = flags & shmcam.FLAG_CAPTURE and flags & shmcam.FLAG_RUN
+        try:
+            if self.cap is not None:
+                # reading blocks until the device delivers, wait only if not capturing
+                if capturing:
+                    ret, frame = self.cap.read()
+                    if not ret:
+                        self.decodeError("no frame read")
+                        return True
+                    self.frameDecoded()
+                    if self.pacer.ready():
+                        self.publish(frame, "bgr24", flags)
+                else:
+                    self.shm.waitForFlags(shmcam.FLAG_CAPTURE | shmcam.FLAG_RUN, timeout=1.0)
+            else:
+                # the frame is decoded anyway, but only converted
+                # and published at the pace given. Corrupt data is skipped,
+                # any other error (timeout, connection closed) reconnects
+                try:
+                    frame = next(self._decoder)
+                except StopIteration:
+                    self.disconnect("end of stream")
+                    return True
+                except ValueError as e:
+                    self.decodeError(str(e))
+                    return True
+                except Exception as e:
+                    self.disconnect(str(e))
+                    return True
+
+                # after an error the frames refer to lost ones, skip until a keyframe
+                if self.waitKeyframe:
+                    if not frame.key_frame:
+                        return True
+                    self.waitKeyframe = False
+                self.frameDecoded()
+
+                if capturing and self.pacer.ready():
+                    img = frame.to_ndarray(format=frame.format.name, width=frame.format.width, height=frame.format.height)
+                    self.publish(img, frame.format.name, flags)
+
+        except Exception as e:
+            logging.error("ERROR EXCEPCIÓN: " + str(e))
+
+        # Calculate metrics
+        self.metrics.endCycle()
+        if time.time() > self.statsTime:
+            logging.info(f"{self.camera_id}: {self.pacer.toString()}, health {self.shm.getStreamHealth()}")
+            if self.pipe is not None:
+                logging.info(f"{self.camera_id}: {self.pipe.toString()}")
+            self.statsTime = time.time() + statsPeriod
+
+        return True
+
+    def publish(self, img, format, flags):
+        '''
+            This routine makes the image available to the external world.
+
+            Args:
+                img (ndarray): image as delivered by the source
+                format (str): format of the image
+                flags (int): snapshot of the flags of the shared memory
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        seq = self.shm.setImage(img, format)
+
+        # send to the pipe
+        if flags & shmcam.FLAG_PIPE:
+            if self.pipe is None:
+                try:
+                    logging.info("Open the communication pipe")
+                    self.pipe = FramePipe(self.pipe_name, self.cam_addr.get("pipe_format", "raw"),
+                                          int(self.cam_addr.get("pipe_quality", 80)))
+                except Exception as e:
+                    logging.error("Error Exception: " + str(e))
+                    return
+            self.pipe.write(self.shm, seq)
+
+    def close(self):
+        '''
+            This routine closes the source of video, the pipe and the access
+            to the shared memory.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self.pipe is not None:
+            self.pipe.close()
+
+        # Disconnecting from the Shared Memory
+        self.closeSource()
+        self.shm.setStreamConnected(False)
+        self.shm.close()
+
+    def closeSource(self):
+        '''
+            This routine closes the source of video, ignoring the errors of a
+            source already lost.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        try:
+            if self.input_container is not None:
+                self.input_container.close()
+            if self.cap is not None:
+                self.cap.release()
+        except Exception as e:
+            logging.error(f"Error closing the source: {str(e)}")
+        self.input_container = None
+        self.input_stream = None
+        self._decoder = None
+        self.cap = None
 
 if __name__ == "__main__":
 
@@ -86,166 +790,35 @@ if __name__ == "__main__":
         exit(0)
     logfile=log["capture_logfile"]
     
-    # Preparing the logging and metrics
+    # Preparing the logging
     logging.basicConfig(filename=logfile, format="%(asctime)s - %(funcName)s:%(lineno)d - %(message)s", level=logging.INFO)
     logging.info("Program started")
-    metrics = timeMetrics.timeMetrics()
 
     try:
         cam_addr = config(filename=sys.argv[1], section='cam_addr')
     except Exception as e:
         logging.error(f"Error reading the source: {str(e)}")
         exit(0)
-    path_video = cam_addr["camera_address"]
-    camera_id = cam_addr["camera_id"]
-    rtsp_server = eval(cam_addr["rtsp_server"])
-
-    # Create area of shared memory
-    logging.info(f"Connecting to shared memory with id: {camera_id}")
-    shm = shmcam.SHMCAM(create=False, name=camera_id)
-
-    # Create the pipe communication
-    if shm.getPipeFlag():
-        try:
-            logging.info("Open the communication pipe")
-            if os.path.exists(pipe_name):
-                os.remove(pipe_name)
-            os.mkfifo(pipe_name)
-            pipeout = open(pipe_name, "wb")
-        except Exception as e:
-            logging.error("Error Exception: " + str(e))
 
-    # connect to the soure of video
-    cap = None
+    # connect to the shared memory, the source of video is opened
+    # (and reopened if lost) by the capture itself
     try:
-        logging.info(f"Opening the video source {path_video}")
-        if isCameraIndex(path_video):
-            logging.info(f"Opening device index: {path_video}")
-            cap = cv2.VideoCapture(int(path_video))
-        else:
-            logging.info(f"Opening device path: {path_video}")
-            input_container = av.open(path_video)
-            input_stream = input_container.streams.get(video=0)[0]
+        capture = CameraCapture(cam_addr)
     except Exception as e:
         logging.error("EXCEPTION: " + str(e))
         exit(-1)
 
     # Wait until run flag is activated
-    while not shm.getRunFlag():
-#        logging.info("Waiting ......")
-        pass
-
-    # prepare RTSP Server creating thread for that if need to stream 
-    # in some cases the camera is provided RTSP Streaming automatically
-#    threadRTSP = None
-#    if rtsp_server:
-#        logging.info("Starting thread for the RTSP Server")
-#        threadRTSP = Thread(target=rtsp_on_thread, args=(camera_id,))
-#        threadRTSP.start()
+    capture.shm.waitForFlags(shmcam.FLAG_RUN)
 
     # retrieve each frame
     logging.info("Now capturing frames . . .")
-
-    # The reason to use av is to support RTSP services. AV also supports paths
-    # However av, does not support indexes for the cameras, at least in some computers.
-    if not isCameraIndex(path_video):
-
-        while(True):
-
-            try:
-
-                for frame in input_container.decode(input_stream):
-
-                    metrics.newCycle()
-
-                    if shm.getCaptureFlag() and shm.getRunFlag():
-
-                        img = frame.to_ndarray(format=frame.format.name, width=frame.format.width, height=frame.format.height)
-
-                        # make available to the external world
-                        shm.setImage(img, frame.format.name)
-
-                        # send to the pipe
-                        if shm.getPipeFlag():
-                            if pipeout is None:
-                                try:
-                                    logging.info("Open the communication pipe")
-                                    if os.path.exists(pipe_name):
-                                        os.remove(pipe_name)
-                                    os.mkfifo(pipe_name)
-                                    pipeout = open(pipe_name, "wb")
-                                except Exception as e:
-                                    logging.error("Error Exception: " + str(e))
-                            pickle_img = pickle.dumps(img)
-                            logging.info(f"Sending image ({sys.getsizeof(img)} / {sys.getsizeof(pickle_img)}) to the PIPE {pipeout} \Data: {type(img)}")
-                            pipeout.write(pickle_img)
-
-                    # need to quit?
-                    if shm.getExitFlag():
-                        logging.ingo(f"Request received to exit module")
-                        break
-
-                    # Calculate metrics
-                    print(f"\r{metrics.endCycle().toString()}", end="", flush=True)
-
-                    time.sleep(1/fps)
-
-            except Exception as e:
-                logging.error("ERROR EXCEPCIÓN: " + str(e))
-
-    # this is a camera index, only address supported by OpenCV
-    else:
-
-        while(True):
-
-            metrics.newCycle()
-
-            if shm.getCaptureFlag() and shm.getRunFlag():
-                try:
-
-                    ret, frame = cap.read()
-
-                    # make available to the external world
-                    if ret:
-                        shm.setImage(frame, "rgb24")
-
-                    # send to the pipe
-                    if shm.getPipeFlag():
-                        if pipeout is None:
-                            try:
-                                logging.info("Open the communication pipe")
-                                if os.path.exists(pipe_name):
-                                    os.remove(pipe_name)
-                                os.mkfifo(pipe_name)
-                                pipeout = open(pipe_name, "wb")
-                            except Exception as e:
-                                logging.error("Error Exception: " + str(e))
-                        pickle_img = pickle.dumps(img)
-                        logging.info(
-                            f"Sending image ({sys.getsizeof(img)} / {sys.getsizeof(pickle_img)}) to the PIPE {pipeout} \Data: {type(img)}")
-                        pipeout.write(pickle_img)
-
-                except Exception as e:
-                    logging.error("ERROR EXCEPCIÓN: " + str(e))
-
-            # need to quit?
-            if shm.getExitFlag():
-                logging.info(f"Request receive to exit module")
-                break
-
-            # Calculate metrics
-            print(f"\r{metrics.endCycle().toString()}", end="", flush=True)
-
-            time.sleep(1 / fps)
-
+    while capture.step():
+        # source lost, wait for the backoff returning early if requested to exit
+        delay = capture.waitTime()
+        if delay > 0:
+            capture.shm.waitForFlags(shmcam.FLAG_EXIT, timeout=delay)
+        print(f"\r{capture.metrics.toString()}", end="", flush=True)
 
     logging.info("Exiting capture program")
-    if shm.getPipeFlag():
-        os.close(pipeout)
-        os.remove(pipe_name)
-
-    # Disconnecting from the Shared Memory
-    shm.close()
-    input_container.close()
-
-
+    capture.close()
@@ -0,0 +1,114 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Captures all the cameras of config.ini in a single process. Each camera is
+# decoded by a CameraCapture, and a bounded pool of threads runs their steps,
+# with at most one step in flight per camera so its frames stay in order.
+# A camera that lost its source is not resubmitted until its reconnection
+# is due, so it does not hold a thread meanwhile.
+# PyAV and OpenCV release the GIL while decoding and converting, so the
+# threads do run in parallel.
+
+import logging
+import sys
+import time
+import timeMetrics
+import shmcam
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from camera_capture import CameraCapture, config
+
+# Seconds between checks of the exit flag of the cameras reconnecting
+RECONNECT_CHECK = 1.0
+
+
+if __name__ == "__main__":
+
+    # Collecting data from the Logging File
+    try:
+        log = config(filename='config.ini', section='logging')
+    except Exception as e:
+        print(f"Error reading the logfile: {str(e)}")
+        exit(0)
+    logfile=log["capture_logfile"]
+
+    # Preparing the logging
+    logging.basicConfig(filename=logfile, format="%(asctime)s - %(threadName)s - %(funcName)s:%(lineno)d - %(message)s", level=logging.INFO)
+    logging.info("Program started")
+    metrics = timeMetrics.timeMetrics()
+
+    # Collecting data for the cameras
+    try:
+        db = config(filename='config.ini', section='global')
+    except Exception as e:
+        logging.error(f"Error reading the source: {str(e)}")
+        exit(0)
+    cameras = [e.strip() for e in db["cameras"].split(',')]
+    workers = int(db.get("capture_workers", len(cameras)))
+
+    # connect each camera to its shared memory, the source of video is
+    # opened (and reopened if lost) by the capture itself
+    captures = []
+    for camera in cameras:
+        try:
+            cam_addr = config(filename=camera, section='cam_addr')
+            captures.append(CameraCapture(cam_addr))
+        except Exception as e:
+            logging.error(f"Camera {camera} not captured: {str(e)}")
+    if not captures:
+        logging.error("No camera to capture")
+        exit(-1)
+
+    # Wait until run flag is activated
+    for capture in captures:
+        capture.shm.waitForFlags(shmcam.FLAG_RUN)
+
+    # retrieve each frame of every camera
+    logging.info(f"Now capturing frames of {len(captures)} cameras with {workers} workers . . .")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="capture") as pool:
+        pending = {pool.submit(capture.step): capture for capture in captures}
+        # cameras waiting for their reconnection, and when it is due
+        delayed = {}
+        while pending or delayed:
+            # wake up at least every RECONNECT_CHECK seconds to notice the
+            # exit of the cameras delayed
+            timeout = None
+            if delayed:
+                timeout = min(min(delayed.values()) - time.time(), RECONNECT_CHECK)
+                timeout = max(timeout, 0.0)
+            if pending:
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                done = set()
+                time.sleep(timeout)
+            metrics.newCycle()
+            for future in done:
+                capture = pending.pop(future)
+                # resubmit the camera until it is requested to exit
+                if not future.result():
+                    logging.info(f"Exiting capture of {capture.camera_id}")
+                    capture.close()
+                elif capture.waitTime() > 0:
+                    delayed[capture] = time.time() + capture.waitTime()
+                else:
+                    pending[pool.submit(capture.step)] = capture
+
+            # the cameras whose reconnection is due, or requested to exit,
+            # run their step again
+            now = time.time()
+            for capture in [c for c, due in delayed.items() if due <= now or c.shm.getExitFlag()]:
+                del delayed[capture]
+                pending[pool.submit(capture.step)] = capture
+            print(f"\r{metrics.endCycle().toString()}", end="", flush=True)
+
+    logging.info("Exiting capture service")
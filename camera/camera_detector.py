@@ -19,6 +19,12 @@ import shmcam
 import numpy as np
 import YOLO_Detector as yolo
 import timeMetrics
+import motionGate
+import detectionCache
+import tracker
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
 import sys
@@ -26,6 +32,10 @@ import sys
 nSamples = 0
 tAverage = 0.0
 tMax = 0.0
+statsPeriod = 60
+
+# Seconds to wait for the capture process to create the shared memory
+SHM_WAIT = 60
 
 def config(filename='camera.ini', section='cam_addr'):
     '''
@@ -59,6 +69,634 @@ def config(filename='camera.ini', section='cam_addr'):
 
     return db
 
+def connectCamera(cameraFile, wait=SHM_WAIT):
+    '''
+        This routine connects to the shared memory of the camera, waiting for
+        the capture process to create it.
+
+        Args:
+            cameraFile (str): camera ini
+            wait (float): seconds to wait for the shared memory
+
+        Returns:
+            DetectorCamera
+
+        Raises:
+            Exception: the camera ini does not exist, or the shared memory was
+                not created in time
+    '''
+    deadline = time.time() + wait
+    while True:
+        try:
+            return DetectorCamera(cameraFile)
+        except FileNotFoundError:
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+class DetectorCamera:
+    '''
+        This class keeps the state of the detection of one camera: its shared
+        memory, the plane to detect on, the regions, the motion gate, the
+        tracker and the last frame processed.
+    '''
+
+    def __init__(self, cameraFile):
+        '''
+            This routine connects to the shared memory of the camera and reads
+            the [detector] and [motion] sections of the camera ini.
+
+            Args:
+                cameraFile (str): camera ini
+
+            Returns:
+                None
+
+            Raises:
+                Exception: the camera ini or the shared memory do not exist
+        '''
+        cam_addr = config(filename=cameraFile, section='cam_addr')
+        self.camera_id = cam_addr["camera_id"]
+        logging.info(f"Connecting to shared memory with id: {self.camera_id}")
+        self.shm = shmcam.SHMCAM(create=False, name=self.camera_id)
+
+        # Classes detected, only persons if not given
+        try:
+            dbd = config(filename=cameraFile, section='detector')
+        except Exception as e:
+            dbd = {}
+        self.classes = [e.strip() for e in dbd.get("classes", "person").split(',')]
+
+        # Engine running the model, see YOLO_Detector
+        self.backend = dbd.get("backend", "auto")
+        self.onnxModel = dbd.get("onnx_model", "yolov5s.onnx")
+        self.threads = int(dbd.get("threads", 0))
+
+        # Regions of interest and tiles, detection on the whole frame if not
+        # given. The regions are cropped from the image at full resolution
+        self.rois = motionGate.parseZones(dbd.get("roi", ""))
+        self.tiled = eval(dbd.get("tiled", "False"))
+        self.tileOverlap = float(dbd.get("tile_overlap", 0.2))
+        self.tileFullFrame = eval(dbd.get("tile_full_frame", "True"))
+        self.regions = []
+
+        # Detection every detect_interval frames. With tracking, the objects
+        # keep their id and are predicted on the frames in between
+        self.detectInterval = int(dbd.get("detect_interval", 1))
+        # None to pipeline on all the runtimes of the detector, see
+        # pipelineFor()
+        self.pipelineDepth = int(dbd["pipeline_depth"]) if "pipeline_depth" in dbd else None
+        self.tracker = None
+        if eval(dbd.get("tracking", "False")):
+            self.tracker = tracker.Tracker(iouThreshold=float(dbd.get("track_iou", 0.3)),
+                                           maxAge=int(dbd.get("track_max_age", 15)),
+                                           minHits=int(dbd.get("track_min_hits", 1)))
+
+        # Boxes of the last detection given back while the frame stays similar
+        self.cache = None
+        if eval(dbd.get("cache", "False")):
+            self.cache = detectionCache.DetectionCache(maxDistance=int(dbd.get("cache_distance", 4)),
+                                                       ttl=float(dbd.get("cache_ttl", 5.0)),
+                                                       hashSize=int(dbd.get("cache_hash_size", 16)))
+
+        # Use the letterboxed plane prepared by the capture process, if any
+        if self.rois or self.tiled:
+            self.plane = 'image'
+        else:
+            self.plane = 'yolo' if 'yolo' in self.shm.getPlaneNames() else 'image'
+        self.letterbox = self.shm.getLetterbox() if self.plane == 'yolo' else None
+        self.frameBuffer = np.zeros(self.shm.getPlaneShape(self.plane), dtype=np.uint8)
+        logging.info(f"{self.camera_id}: detecting on plane {self.plane}")
+
+        # Motion prefilter, detection on every frame if not enabled
+        try:
+            dbm = config(filename=cameraFile, section='motion')
+        except Exception as e:
+            dbm = {}
+        self.gate = motionGate.createGate(dbm)
+        if self.gate is not None:
+            self.gatePlane = [p for p in ('thumb', 'quarter', 'half', 'image') if p in self.shm.getPlaneNames()][0]
+            self.gateBuffer = np.zeros(self.shm.getPlaneShape(self.gatePlane), dtype=np.uint8)
+            logging.info(f"{self.camera_id}: motion gate on plane {self.gatePlane}")
+
+        self.lastSeq = 0
+        self.lastDetectedSeq = 0
+        # the tracks are published from several threads when pipelined
+        self._lock = threading.Lock()
+
+    def setRegions(self, detector):
+        '''
+            This routine computes the regions to detect on, if configured.
+
+            Args:
+                detector (YOLO_Detector): detector used
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self.rois or self.tiled:
+            height, width = self.shm.getPlaneShape('image')[:2]
+            self.regions = detector.regions(width, height, self.rois, self.tiled, self.tileOverlap,
+                                            self.tileFullFrame)
+            logging.info(f"{self.camera_id}: detecting on regions {self.regions}")
+
+    def nextFrame(self, out=None):
+        '''
+            This routine gets the latest frame of the camera, if it is new,
+            detection is enabled, it is due by detect_interval and the motion
+            gate lets it through. On the frames skipped the tracks predicted
+            are published.
+
+            Args:
+                out (ndarray): buffer where to copy the frame, the one of the
+                    camera (reused on every call) if None
+
+            Returns:
+                tuple (seq, frame), or None if there is nothing to detect
+
+            Raises:
+                None
+        '''
+        # frames arriving while not detecting are skipped
+        flags = self.shm.getFlags()
+        if not (flags & shmcam.FLAG_YOLO and flags & shmcam.FLAG_RUN):
+            self.lastSeq = self.shm.getLatestSeq()
+            return None
+
+        seq = self.shm.getLatestSeq()
+        if seq == self.lastSeq:
+            return None
+        self.lastSeq = seq
+
+        if self.lastDetectedSeq and seq - self.lastDetectedSeq < self.detectInterval:
+            self.skip(seq)
+            return None
+
+        # With no motion the frame is skipped, and the boxes of the last
+        # detection (or the tracks) are kept
+        if self.gate is not None:
+            latest = self.shm.getFrame(seq, out=self.gateBuffer, plane=self.gatePlane)
+            if latest is None:
+                return None
+            if not self.gate.check(latest[2], latest[1]):
+                self.skip(seq)
+                return None
+
+        # The frame is copied into the same buffer every time, checking it
+        # was not torn by the capture process
+        latest = self.shm.getFrame(seq, out=self.frameBuffer if out is None else out, plane=self.plane)
+        if latest is None:
+            return None
+        self.lastDetectedSeq = seq
+        return seq, latest[2]
+
+    def skip(self, seq):
+        '''
+            This routine publishes the tracks predicted on a frame not detected.
+
+            Args:
+                seq (int): sequence number of the frame
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self.tracker is not None:
+            with self._lock:
+                self.shm.setBoxes(self.tracker.predict(seq), seq)
+
+    def pipelineFor(self, detector):
+        '''
+            This routine gets the depth of the pipeline of the camera: the
+            one configured, or one frame per runtime of the detector. With a
+            single runtime the frames are detected one by one.
+
+            Args:
+                detector (YOLO_Detector): detector used
+
+            Returns:
+                depth of the pipeline, 0 for no pipeline
+
+            Raises:
+                None
+        '''
+        if self.pipelineDepth is not None:
+            return self.pipelineDepth
+        return detector.workers if detector.workers > 1 else 0
+
+    def detect(self, detector, frame):
+        '''
+            This routine detects the objects of the frame, on the regions if
+            configured.
+
+            Args:
+                detector (YOLO_Detector): detector used
+                frame (ndarray): frame returned by nextFrame()
+
+            Returns:
+                list of boxes, as returned by YOLO_Detector.detect()
+
+            Raises:
+                None
+        '''
+        signature, boxes = self.lookup(frame)
+        if boxes is not None:
+            return boxes
+        if self.regions:
+            boxes = detector.detect_regions(frame, self.regions)
+        else:
+            boxes = detector.detect(frame, letterbox=self.letterbox)
+        self.store(signature, boxes)
+        return boxes
+
+    def lookup(self, frame):
+        '''
+            This routine gets the boxes of the cache for the frame, if
+            enabled and the frame is similar to the one detected last.
+
+            Args:
+                frame (ndarray): frame returned by nextFrame()
+
+            Returns:
+                tuple (signature, boxes), boxes None if they need to be
+                detected and signature None if there is no cache
+
+            Raises:
+                None
+        '''
+        if self.cache is None:
+            return None, None
+        signature = self.cache.signature(frame)
+        return signature, self.cache.get(signature)
+
+    def store(self, signature, boxes):
+        '''
+            This routine stores the boxes detected in the cache, if enabled.
+
+            Args:
+                signature (ndarray): signature returned by lookup()
+                boxes (list): boxes detected
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self.cache is not None:
+            self.cache.put(signature, boxes)
+
+    def publish(self, boxes, seq):
+        '''
+            This routine publishes the objects detected on a frame, as tracks
+            if tracking.
+
+            Args:
+                boxes (list): boxes, as returned by YOLO_Detector.detect()
+                seq (int): sequence number of the frame
+
+            Returns:
+                list of boxes published
+
+            Raises:
+                None
+        '''
+        with self._lock:
+            if self.tracker is not None:
+                boxes = self.tracker.update(boxes, seq)
+            self.shm.setBoxes(boxes, seq)
+        return boxes
+
+class LatestQueue:
+    '''
+        This class is a queue of one item that keeps only the newest one:
+        putting an item replaces the one not taken yet.
+    '''
+
+    def __init__(self):
+        '''
+            This routine initializes the queue.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._item = None
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        '''
+            This routine puts the item in the queue.
+
+            Args:
+                item: item to put, not None
+
+            Returns:
+                the item replaced, None if the queue was empty
+
+            Raises:
+                None
+        '''
+        with self._condition:
+            dropped = self._item
+            self._item = item
+            self._condition.notify()
+        return dropped
+
+    def get(self, timeout=None):
+        '''
+            This routine takes the item of the queue, waiting for it.
+
+            Args:
+                timeout (float): maximum seconds to wait, forever if None
+
+            Returns:
+                the item, None if the wait timed out
+
+            Raises:
+                None
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: self._item is not None, timeout)
+            item = self._item
+            self._item = None
+        return item
+
+
+class DetectorPipeline:
+    '''
+        This class runs the detection of a camera in three stages, so that the
+        stages of consecutive frames overlap:
+            - fetch (feed(), on the caller thread): the newest frame is copied
+              out of the shared memory into a free buffer
+            - inference: up to depth frames are detected at once on a pool of
+              threads. The newest frame fetched waits in a LatestQueue until
+              one of the depth slots is free, the older ones are dropped
+            - publish: the boxes are tracked and published, in the order of
+              the frames
+        The inference (RKNN, torch) releases the GIL, so the threads do run in
+        parallel. The frame buffers are allocated once and recycled.
+    '''
+
+    def __init__(self, camera, detector, depth=2):
+        '''
+            This routine creates the buffers and starts the stages.
+
+            Args:
+                camera (DetectorCamera): camera detected
+                detector (YOLO_Detector): detector used
+                depth (int): frames detected at the same time
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.camera = camera
+        self.detector = detector
+        self.dropped = 0
+        self._running = True
+        self._frames = LatestQueue()
+        self._results = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="inference")
+        # frames taken from the LatestQueue and not published yet
+        self._slots = threading.Semaphore(depth)
+
+        # a buffer per frame in a slot, plus the one waiting in the
+        # LatestQueue and the one being fetched
+        self._free = queue.Queue()
+        for i in range(depth + 2):
+            self._free.put(np.empty(camera.shm.getPlaneShape(camera.plane), dtype=np.uint8))
+        self._buffer = None
+
+        self._threads = [threading.Thread(target=self._dispatch, name="dispatch"),
+                         threading.Thread(target=self._publish, name="publish")]
+        for thread in self._threads:
+            thread.start()
+
+    def feed(self):
+        '''
+            This routine fetches the latest frame of the camera, if any to
+            detect (see DetectorCamera.nextFrame()), into the pipeline.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self._buffer is None:
+            try:
+                self._buffer = self._free.get_nowait()
+            except queue.Empty:
+                return
+        latest = self.camera.nextFrame(out=self._buffer)
+        if latest is None:
+            return
+        self._buffer = None
+        dropped = self._frames.put(latest)
+        if dropped is not None:
+            self.dropped += 1
+            self._free.put(dropped[1])
+
+    def _dispatch(self):
+        '''
+            This routine starts the inference of the newest frame fetched. It
+            waits for a free slot before taking the frame, so that the frame
+            taken is the newest when the detection starts.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        while self._running:
+            if not self._slots.acquire(timeout=1.0):
+                continue
+            latest = self._frames.get(timeout=1.0)
+            if latest is None:
+                self._slots.release()
+                continue
+            seq, frame = latest
+            future = self._executor.submit(self.camera.detect, self.detector, frame)
+            self._results.put((seq, frame, future))
+        self._results.put(None)
+
+    def _publish(self):
+        '''
+            This routine publishes the boxes of the frames detected, in order,
+            and recycles their buffers and slots.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            seq, frame, future = item
+            try:
+                boxes = self.camera.publish(future.result(), seq)
+                for b in boxes:
+                    if b[1] == 'person':
+                        logging.info(f"Detected person on box {b}")
+            except Exception as e:
+                logging.error(str(e))
+            self._free.put(frame)
+            self._slots.release()
+
+    def close(self):
+        '''
+            This routine stops the stages, once the frames being detected are
+            published.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._executor.shutdown()
+
+class DetectorLoader:
+    '''
+        This class loads the detector in a background thread, once, the first
+        time it is needed, and warms it up before handing it out. Meanwhile
+        the frames keep being consumed without detection, and the detection
+        can be switched on at any time without restarting.
+    '''
+
+    def __init__(self, factory):
+        '''
+            This routine initializes the loader, nothing is loaded yet.
+
+            Args:
+                factory (callable): function creating the YOLO_Detector
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.factory = factory
+        self.detector = None
+        self.error = None
+        self.startTime = time.time()
+        self.readyTime = None
+        self._thread = None
+
+    def start(self):
+        '''
+            This routine starts loading the detector, if not started yet.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if self._thread is None:
+            logging.info("Initializing YOLO Detector . . . ")
+            self._thread = threading.Thread(target=self._load, name="loader", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        '''
+            This routine creates and warms up the detector, on the thread of
+            the loader.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        try:
+            requested = time.time()
+            detector = self.factory()
+            detector.warmup()
+        except Exception as e:
+            logging.error("EXCEPTION: " + str(e))
+            self.error = e
+            return
+        self.readyTime = time.time()
+        self.detector = detector
+        logging.info(f"YOLO Detector initialized! {self.toString()}, "
+                     f"ready {self.readyTime - requested:.1f}s after requested")
+
+    def get(self):
+        '''
+            This routine gets the detector, starting to load it if needed.
+
+            Args:
+                None
+
+            Returns:
+                YOLO_Detector, or None if not loaded yet
+
+            Raises:
+                Exception: the detector could not be loaded
+        '''
+        self.start()
+        if self.error is not None:
+            raise Exception(f"YOLO Detector not loaded: {self.error}")
+        return self.detector
+
+    def toString(self):
+        '''
+            This routine returns a string with the startup times.
+
+            Args:
+                None
+
+            Returns:
+                string with the times of loading and warming up the model
+
+            Raises:
+                None
+        '''
+        if self.detector is None:
+            return "YOLO Detector not loaded"
+        return f"Model loaded in {self.detector.loadTime:.1f}s, warmed up in {self.detector.warmupTime:.1f}s, " \
+               f"ready {self.readyTime - self.startTime:.1f}s after start"
+
 if __name__ == "__main__":
 
     # Check args input
@@ -79,62 +717,93 @@ if __name__ == "__main__":
     logging.info("Program started")
     metrics = timeMetrics.timeMetrics()
 
+    # Connect to the area of shared memory, waiting for the capture process
+    # to create it
     try:
-        cam_addr = config(filename=sys.argv[1], section='cam_addr')
+        camera = connectCamera(sys.argv[1])
     except Exception as e:
         logging.error(f"Error reading the source: {str(e)}")
         exit(0)
-    path_video = cam_addr["camera_address"]
-    camera_id = cam_addr["camera_id"]
-
-    # Create area of shared memory
-    logging.info(f"Connecting to shared memory with id: {camera_id}")
-    shm = shmcam.SHMCAM(create=False, name=camera_id)
+    shm = camera.shm
 
-    # Initialize the Yolo detector
+    # The Yolo detector is loaded in the background the first time the
+    # yolo flag is set, and the frames are not detected until it is ready
+    loader = DetectorLoader(lambda: yolo.YOLO_Detector(classes=camera.classes, backend=camera.backend,
+                                                       onnx_model=camera.onnxModel, threads=camera.threads))
+    detector = None
     if shm.getYoloFlag():
-        try:
-            logging.info(f"Initializing YOLO Detector . . . ")
-            # Initialize the Yolo detector
-            detector = yolo.YOLO_Detector()
-        except Exception as e:
-            logging.error("EXCEPTION: " + str(e))
-            exit(-1)
-        logging.info("YOLO Detector initialized!")
+        loader.start()
 
     # Wait until run flag is activated
-    while not shm.getRunFlag():
-        pass
+    shm.waitForFlags(shmcam.FLAG_RUN)
         
     logging.info("Now detecting objects.")
 
-    frame = None
+    pipeline = None
+    statsTime = time.time() + statsPeriod
     while True:
 
+        # Sleep until the capture process stores a frame not processed yet
+        shm.waitForNewFrame(camera.lastSeq, timeout=1.0)
+
         metrics.newCycle()
+        flags = shm.getFlags()
 
-        if shm.getYoloFlag() and shm.getRunFlag():
+        if flags & shmcam.FLAG_YOLO and flags & shmcam.FLAG_RUN:
             try:
-                # Find the objects
-                frame = shm.getImage()
-
-                #boxes = detector.detectObjects(frame)
-                boxes = detector.detect(frame)
-                
-                if detector.getPersons() > 0:
-                    for b in boxes:
-                        logging.info(f"Detected person on box {b}")
+                if detector is None:
+                    detector = loader.get()
+                    if detector is not None:
+                        camera.setRegions(detector)
+
+                        # Pipelined detection, the frames are detected one by
+                        # one if not enabled
+                        depth = camera.pipelineFor(detector)
+                        if depth > 0:
+                            pipeline = DetectorPipeline(camera, detector, depth)
+                            logging.info(f"Detection pipelined with depth {depth}")
+
+                # Find the objects, the frames arriving while loading are skipped
+                latest = None
+                if detector is None:
+                    camera.lastSeq = shm.getLatestSeq()
+                elif pipeline is not None:
+                    pipeline.feed()
+                else:
+                    latest = camera.nextFrame()
+                if latest is not None:
+                    seq, frame = latest
+                    boxes = camera.publish(camera.detect(detector, frame), seq)
 
-                shm.setBoxes(boxes)
+                    if detector.getPersons() > 0:
+                        for b in boxes:
+                            logging.info(f"Detected person on box {b}")
 
             except Exception as e:
                 logging.error(str(e))
+                if loader.error is not None:
+                    break
+        else:
+            shm.waitForFlags(shmcam.FLAG_YOLO | shmcam.FLAG_RUN, timeout=1.0)
 
-        if shm.getExitFlag():
+        if flags & shmcam.FLAG_EXIT:
             break
 
         # Calculate metrics
         print(f"\r{metrics.endCycle().toString()}", end="", flush=True)
+        if time.time() > statsTime:
+            logging.info(loader.toString())
+            if camera.gate is not None:
+                logging.info(camera.gate.toString())
+            if camera.cache is not None:
+                logging.info(camera.cache.toString())
+            if pipeline is not None:
+                logging.info(f"Frames dropped by the pipeline: {pipeline.dropped}")
+            statsTime = time.time() + statsPeriod
 
+    if pipeline is not None:
+        pipeline.close()
+    if detector is not None:
+        detector.close()
     logging.info("Exiting view program")
     shm.close()
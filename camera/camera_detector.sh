@@ -10,7 +10,7 @@ export CAMERA_PATH=/home/odroid/projects/AutomatedHome/camera
 source $CAMERA_ENV/bin/activate
 echo "*****" >> $CAMERA_PATH/cd.log
 echo "Environment is:" $VIRTUAL_ENV >> $CAMERA_PATH/cd.log
-sleep 30
+sleep 1
 
 # Start the program
 pwd
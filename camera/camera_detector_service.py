@@ -0,0 +1,176 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Detects the objects of all the cameras of config.ini in a single process,
+# with one instance of the model. The latest new frame of each camera is
+# collected and all of them run as one batch (see YOLO_Detector.detect_batch),
+# then the boxes are written back to the shared memory of each camera.
+
+import logging
+import time
+import shmcam
+import YOLO_Detector as yolo
+import timeMetrics
+from camera_detector import config, connectCamera, DetectorLoader
+
+statsPeriod = 60
+
+# Seconds to wait for a new frame of one camera when no camera has any
+BATCH_WAIT = 0.01
+
+
+if __name__ == "__main__":
+
+    # Collecting data from the Logging File
+    try:
+        log = config(filename='config.ini', section='logging')
+    except Exception as e:
+        print(f"Error reading the logfile: {str(e)}")
+        exit(0)
+    logfile=log["detector_logfile"]
+
+    # Preparing the logging
+    logging.basicConfig(filename=logfile, format="%(asctime)s - %(funcName)s:%(lineno)d - %(message)s", level=logging.INFO)
+    logging.info("Program started")
+    metrics = timeMetrics.timeMetrics()
+
+    # Collecting data for the cameras
+    try:
+        db = config(filename='config.ini', section='global')
+    except Exception as e:
+        logging.error(f"Error reading the source: {str(e)}")
+        exit(0)
+    cameraFiles = [e.strip() for e in db["cameras"].split(',')]
+
+    cameras = []
+    for cameraFile in cameraFiles:
+        try:
+            cameras.append(connectCamera(cameraFile))
+        except Exception as e:
+            logging.error(f"Camera {cameraFile} not detected: {str(e)}")
+    if not cameras:
+        logging.error("No camera to detect")
+        exit(-1)
+
+    # Classes detected, only persons if not given
+    try:
+        dbd = config(filename='config.ini', section='detector')
+    except Exception as e:
+        dbd = {}
+    classes = [e.strip() for e in dbd.get("classes", "person").split(',')]
+
+    # The Yolo detector, one for all the cameras, is loaded in the background
+    # the first time the yolo flag of a camera is set
+    loader = DetectorLoader(lambda: yolo.YOLO_Detector(npu_cores=int(db.get("npu_cores", 0)), classes=classes,
+                                                       backend=dbd.get("backend", "auto"),
+                                                       onnx_model=dbd.get("onnx_model", "yolov5s.onnx"),
+                                                       threads=int(dbd.get("threads", 0))))
+    detector = None
+    if any(camera.shm.getYoloFlag() for camera in cameras):
+        loader.start()
+
+    # Wait until run flag is activated
+    for camera in cameras:
+        camera.shm.waitForFlags(shmcam.FLAG_RUN)
+
+    logging.info(f"Now detecting objects of {len(cameras)} cameras.")
+    statsTime = time.time() + statsPeriod
+    turn = 0
+    while True:
+
+        # cameras requested to exit are not detected anymore
+        for camera in [c for c in cameras if c.shm.getExitFlag()]:
+            logging.info(f"Exiting detection of {camera.camera_id}")
+            camera.shm.close()
+            cameras.remove(camera)
+        if not cameras:
+            break
+
+        # the frames arriving while loading are skipped
+        if detector is None:
+            try:
+                if any(camera.shm.getYoloFlag() for camera in cameras):
+                    detector = loader.get()
+            except Exception as e:
+                logging.error(str(e))
+                break
+            if detector is None:
+                for camera in cameras:
+                    camera.lastSeq = camera.shm.getLatestSeq()
+                turn = (turn + 1) % len(cameras)
+                cameras[turn].shm.waitForNewFrame(cameras[turn].lastSeq, timeout=BATCH_WAIT)
+                continue
+            for camera in cameras:
+                camera.setRegions(detector)
+
+        # collect the new frames of all the cameras
+        batch = []
+        for camera in cameras:
+            frame = camera.nextFrame()
+            if frame is not None:
+                batch.append((camera, frame[0], frame[1]))
+
+        # nothing new, sleep on the cameras in turn
+        if not batch:
+            turn = (turn + 1) % len(cameras)
+            cameras[turn].shm.waitForNewFrame(cameras[turn].lastSeq, timeout=BATCH_WAIT)
+            continue
+
+        metrics.newCycle()
+        try:
+            # the frames similar to the last detected take the boxes cached,
+            # and the cameras with regions run their own batch of regions
+            whole, signatures, cached, results = [], [], [], []
+            for camera, seq, frame in batch:
+                if camera.regions:
+                    continue
+                signature, boxes = camera.lookup(frame)
+                if boxes is None:
+                    whole.append((camera, seq, frame))
+                    signatures.append(signature)
+                else:
+                    cached.append((camera, seq, frame))
+                    results.append(boxes)
+            detected = []
+            if whole:
+                detected = detector.detect_batch([frame for camera, seq, frame in whole],
+                                                 letterboxes=[camera.letterbox for camera, seq, frame in whole])
+            for (camera, seq, frame), signature, boxes in zip(whole, signatures, detected):
+                camera.store(signature, boxes)
+            whole = cached + whole
+            results += detected
+            for camera, seq, frame in batch:
+                if camera.regions:
+                    whole.append((camera, seq, frame))
+                    results.append(camera.detect(detector, frame))
+            for (camera, seq, frame), boxes in zip(whole, results):
+                for b in camera.publish(boxes, seq):
+                    logging.info(f"{camera.camera_id}: detected {b[1]} on box {b}")
+        except Exception as e:
+            logging.error(str(e))
+
+        # Calculate metrics
+        print(f"\r{metrics.endCycle().toString()} Batch: {len(batch)}", end="", flush=True)
+        if time.time() > statsTime:
+            logging.info(loader.toString())
+            for camera in cameras:
+                if camera.gate is not None:
+                    logging.info(f"{camera.camera_id}: {camera.gate.toString()}")
+                if camera.cache is not None:
+                    logging.info(f"{camera.camera_id}: {camera.cache.toString()}")
+            statsTime = time.time() + statsPeriod
+
+    if detector is not None:
+        detector.close()
+    logging.info("Exiting detector service")
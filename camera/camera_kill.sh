@@ -2,8 +2,10 @@
 
 pkill -f 'camera_record.py'
 pkill -f 'camera_detector.py'
+pkill -f 'camera_detector_service.py'
 pkill -f 'camera_rtsp.py'
 pkill -f 'camera_capture.py'
+pkill -f 'camera_capture_service.py'
 pkill -f 'camera_main.py'
 
 echo 'All processes killed!'
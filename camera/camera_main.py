@@ -116,10 +116,19 @@ if __name__ == "__main__":
             print(f"Error reading the source: {str(e)}")
             exit(0)
 
+        # Planes prepared by the capture process besides the image (optional)
+        try:
+            dbp = config(filename=camera, section='preprocess')
+        except Exception as e:
+            dbp = {}
+
 #        print (f"Read dbc: {dbc}")
         # Create area of shared memory for that camera
         logging.info(f"Creating shared memory area for {dbc['camera_id']}")
-        shm = shmcam.SHMCAM(create=True, name=dbc["camera_id"],maxImageWidth=1280, maxImageHeight=720)
+        shm = shmcam.SHMCAM(create=True, name=dbc["camera_id"],maxImageWidth=1280, maxImageHeight=720,
+                            yoloSize=int(dbp.get("yolo_size", 0)), thumbWidth=int(dbp.get("thumb_width", 0)),
+                            pyramidLevels=int(dbp.get("pyramid_levels", 0)))
+        logging.info(f"    ----> Planes: {shm.getPlaneNames()}")
         # Wait for others to join if needed
         # then initiate the running
         time.sleep(1)
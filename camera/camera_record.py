@@ -101,6 +101,7 @@ class Recorder():
         self.out = None
         self.image = None
         self.fn = None                # it keeps the name of the filename during active recording
+        self.lastSeq = 0              # sequence number of the last frame read from shared memory
 
         # Finite state machine of the recorder
         self.fsm = Fysom( {
@@ -270,7 +271,7 @@ class Recorder():
             for a signal to run. the frequency at which it runs is commanded from
             outside this routine.
             If the state machine is recording, it queues from shared memory the
-            image into the READ QUEUE.
+            image into the READ QUEUE, only if it was not read before.
 
             Args:
                 None
@@ -288,8 +289,12 @@ class Recorder():
 #            handle(sig, None)
 
             if self.fsm.isstate('recording'):
-                frame = self.shm.getImage()
-                self.framesReadQueue.put(frame)
+                # wait for the next frame, at most one record period
+                self.shm.waitForNewFrame(self.lastSeq, timeout=1/self.fps)
+                seq, timestamp, frame = self.shm.getLatestFrame()
+                if seq != self.lastSeq and frame is not None:
+                    self.lastSeq = seq
+                    self.framesReadQueue.put(frame)
 
         except Exception as e:
             logging.error("ERROR EXCEPTION READ!" + str(e))
@@ -310,27 +315,27 @@ class Recorder():
         '''
 
         eventList = []
+        flags = self.shm.getFlags()
 
         # Events has a priority to be executed whenever it is possible. Lower number, higher priority.
         # It is in the form of a tuple (PRIO, EVENT)
-        if self.shm.getExitFlag():   # need to exit
+        if flags & shmcam.FLAG_EXIT:   # need to exit
             eventList.append((0, 'exit'))
         else:   # if exit is False, do nothing
             pass
 
-        if self.shm.getRunFlag():
+        if flags & shmcam.FLAG_RUN:
             eventList.append((1, 'run'))
         else:
             eventList.append((1, 'norun'))
 
-        if self.shm.getRecordFlag():
+        if flags & shmcam.FLAG_RECORD:
             eventList.append((2, 'record'))
         else:
             eventList.append((2, 'norecord'))
 
         # See the number of items detected
-        objects = self.shm.getBoxes()
-        self.record, self.fn = self.recordVideo(len(objects))
+        self.record, self.fn = self.recordVideo(self.shm.getBoxesCount())
         if self.record:
             eventList.append((3, 'saverec'))
         else:
@@ -378,13 +383,12 @@ class Recorder():
         '''
 
         # get frames from the read queue and put it into the record queue.
-        # if no frame is available from the read queue, put the last one.
+        # if no new frame is available from the read queue, nothing is queued
+        # so the same image is not written twice.
         try:
             self.image = self.framesReadQueue.get(block=False)
         except queue.Empty as e:
-#            print("EMPTY QUEUE!")
-#            self.image = self.image
-            pass
+            return
 
         try:
             self.framesRecordQueue.put(self.image, block=False)
@@ -76,45 +76,54 @@ if __name__ == "__main__":
     shm = shmcam.SHMCAM(create=False, name="CAMERA_SHMEM")
 
     # Wait until run flag is activated
-    while not shm.getRunFlag():
-        logging.info("Waiting ......")
-        pass
+    logging.info("Waiting ......")
+    shm.waitForFlags(shmcam.FLAG_RUN)
 
+    lastSeq = 0
     while True:
 
         metrics.newCycle()
+        flags = shm.getFlags()
 
-        if shm.getRunFlag() and shm.getViewFlag():
-            try:
-                # Display the video
-                frame = shm.getImage()
+        if flags & shmcam.FLAG_RUN and flags & shmcam.FLAG_VIEW:
 
-                # if detector is activated, modify image with detections
-                if shm.getYoloFlag():
+            # Display the video, once per new frame. The wait is short
+            # to keep the window responsive
+            seq = shm.waitForNewFrame(lastSeq, timeout=0.1)
+            if seq != lastSeq:
+                lastSeq = seq
+                try:
+                    frame = shm.getImage()
 
-                    boxes = shm.getBoxes()
+                    # if detector is activated, modify image with detections
+                    if flags & shmcam.FLAG_YOLO:
 
-                    for box in boxes:
-                        #font = cv2.FONT_HERSHEY_PLAIN
-                        font = cv2.FONT_HERSHEY_SIMPLEX
-                        x, y, w, h = box[0]
-                        label = box[1]
-                        confidence = box[2]
-                        color = box[3]
-                        cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
-                        cv2.putText(frame, label + ' ' + str(round(confidence*100)) + '%', (x-10, y-10), font, 1 / 2, color, 2)
+                        boxes = shm.getBoxes()
 
+                        for box in boxes:
+                            #font = cv2.FONT_HERSHEY_PLAIN
+                            font = cv2.FONT_HERSHEY_SIMPLEX
+                            x, y, w, h = box[0]
+                            label = box[1]
+                            confidence = box[2]
+                            color = box[3]
+                            cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+                            cv2.putText(frame, label + ' ' + str(round(confidence*100)) + '%', (x-10, y-10), font, 1 / 2, color, 2)
 
-                cv2.imshow("Video", frame)
 
-            except Exception as e:
-                logging.error("Error Getting Image, Boxes or printing boxes: " + str(e))
-                pass
+                    cv2.imshow("Video", frame)
+
+                except Exception as e:
+                    logging.error("Error Getting Image, Boxes or printing boxes: " + str(e))
+                    pass
 
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
-        if shm.getExitFlag():
+        else:
+            shm.waitForFlags(shmcam.FLAG_RUN | shmcam.FLAG_VIEW, timeout=1.0)
+
+        if flags & shmcam.FLAG_EXIT:
             break
 
         # Calculate metrics
@@ -0,0 +1,137 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import threading
+import time
+import cv2
+import numpy as np
+
+
+class DetectionCache:
+    '''
+        This class keeps the boxes of the last detection together with a
+        signature of the frame, and gives them back for the next frames with
+        a similar signature instead of detecting again. The signature is a
+        difference hash: the frame is reduced to (hashSize + 1) x hashSize
+        and each bit tells whether a pixel is brighter than its right
+        neighbour, so it does not change with the overall lighting. The boxes
+        are detected again after ttl seconds anyway.
+    '''
+
+    def __init__(self, maxDistance=4, ttl=5.0, hashSize=16):
+        '''
+            This routine initializes the cache.
+
+            Args:
+                maxDistance (int): bits that can differ between two signatures
+                    for the frames to be similar
+                ttl (float): seconds the boxes are given back before detecting
+                    again, 0 for no limit
+                hashSize (int): side of the signature, hashSize x hashSize bits.
+                    The bigger, the smaller the changes noticed
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.maxDistance = maxDistance
+        self.ttl = ttl
+        self.hashSize = hashSize
+        self.hits = 0
+        self.misses = 0
+        self._signature = None
+        self._boxes = None
+        self._time = 0.0
+        self._lock = threading.Lock()
+
+    def signature(self, frame):
+        '''
+            This routine calculates the signature of the frame.
+
+            Args:
+                frame (ndarray): frame, color or grayscale
+
+            Returns:
+                ndarray of hashSize x hashSize booleans
+
+            Raises:
+                None
+        '''
+        small = cv2.resize(frame, (self.hashSize + 1, self.hashSize), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = small.mean(axis=-1)
+        return small[:, 1:] > small[:, :-1]
+
+    def get(self, signature, now=None):
+        '''
+            This routine gets the boxes cached for a frame, if similar to the
+            frame detected last and not expired.
+
+            Args:
+                signature (ndarray): signature of the frame, see signature()
+                now (float): time of the frame, now if None
+
+            Returns:
+                list of boxes, or None if they need to be detected
+
+            Raises:
+                None
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self._signature is None or (self.ttl > 0 and now - self._time > self.ttl) or \
+                    np.count_nonzero(signature != self._signature) > self.maxDistance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy.deepcopy(self._boxes)
+
+    def put(self, signature, boxes, now=None):
+        '''
+            This routine stores the boxes detected on a frame.
+
+            Args:
+                signature (ndarray): signature of the frame, see signature()
+                boxes (list): boxes detected
+                now (float): time of the detection, now if None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        with self._lock:
+            self._signature = signature
+            self._boxes = copy.deepcopy(boxes)
+            self._time = time.time() if now is None else now
+
+    def toString(self):
+        '''
+            This routine returns a string with the counters of the cache.
+
+            Args:
+                None
+
+            Returns:
+                string with the hits and misses
+
+            Raises:
+                None
+        '''
+        return f"Detection cache hits / misses: {self.hits} / {self.misses}"
@@ -0,0 +1,220 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Engines running the YOLOv5 model for YOLO_Detector. Every runtime takes the
+# image letterboxed by the detector (RGB, IMG_SIZE x IMG_SIZE, uint8) and
+# returns the raw outputs of the model, which the detector post processes:
+# either the three heads (as the RKNN model) or the decoded boxes (as the
+# ONNX export of ultralytics). A runtime is used by one thread at a time, the
+# detector keeps one per worker.
+
+import cv2
+
+# Names of the backends in the ini files
+BACKENDS = ('auto', 'rknn', 'torch', 'onnxruntime', 'opencv')
+
+
+class RKNNBackend:
+    '''
+        This class runs the RKNN model on a core of the Rockchip NPU.
+    '''
+
+    def __init__(self, model, core=None):
+        '''
+            This routine loads the model and initializes the runtime.
+
+            Args:
+                model (str): path of the RKNN model
+                core (int): NPU core (RKNNLite.NPU_CORE_x), None for the
+                    default one
+
+            Returns:
+                None
+
+            Raises:
+                Exception: error loading the model or initializing the runtime
+        '''
+        try:
+            from rknnlite.api import RKNNLite
+        except ImportError as e:
+            raise Exception(f"Error: {e}")
+
+        self.rknn_lite = RKNNLite()
+
+        # load RKNN model
+        print('--> Load RKNN model')
+        ret = self.rknn_lite.load_rknn(model)
+        if ret != 0:
+            raise Exception(f"Error loading the RKNN model. Error {ret}")
+        print('done')
+
+        # init runtime environment
+        print('--> Init runtime environment')
+        # run on RK356x/RK3588 with Debian OS, do not need specify target.
+        if core is not None:
+            ret = self.rknn_lite.init_runtime(core_mask=core)
+        else:
+            ret = self.rknn_lite.init_runtime()
+        if ret != 0:
+            raise Exception(f"Init runtime environment failed. Error {ret}")
+        print('done')
+
+    def inference(self, frame):
+        '''
+            This routine runs the image through the model.
+
+            Args:
+                frame (ndarray): letterboxed RGB image
+
+            Returns:
+                list of outputs of the model
+
+            Raises:
+                None
+        '''
+        return self.rknn_lite.inference(inputs=[frame])
+
+    def release(self):
+        '''
+            This routine releases the runtime.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.rknn_lite.release()
+
+
+class ONNXRuntimeBackend:
+    '''
+        This class runs an ONNX model on the CPU with ONNX Runtime.
+    '''
+
+    def __init__(self, model, threads=0):
+        '''
+            This routine creates the session of the model.
+
+            Args:
+                model (str): path of the ONNX model
+                threads (int): threads of the session, 0 for all the cores
+
+            Returns:
+                None
+
+            Raises:
+                Exception: onnxruntime not installed or error loading the model
+        '''
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise Exception(f"Error: {e}")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def inference(self, frame):
+        '''
+            This routine runs the image through the model.
+
+            Args:
+                frame (ndarray): letterboxed RGB image
+
+            Returns:
+                list of outputs of the model
+
+            Raises:
+                None
+        '''
+        # NCHW, float scaled to 0..1
+        blob = cv2.dnn.blobFromImage(frame, scalefactor=1 / 255.0)
+        return self.session.run(None, {self.input_name: blob})
+
+    def release(self):
+        '''
+            This routine releases the session.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.session = None
+
+
+class OpenCVBackend:
+    '''
+        This class runs an ONNX model on the CPU with the DNN module of
+        OpenCV, without any other dependency.
+    '''
+
+    def __init__(self, model):
+        '''
+            This routine loads the model.
+
+            Args:
+                model (str): path of the ONNX model
+
+            Returns:
+                None
+
+            Raises:
+                Exception: error loading the model
+        '''
+        self.net = cv2.dnn.readNetFromONNX(model)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.output_names = self.net.getUnconnectedOutLayersNames()
+
+    def inference(self, frame):
+        '''
+            This routine runs the image through the model.
+
+            Args:
+                frame (ndarray): letterboxed RGB image
+
+            Returns:
+                list of outputs of the model
+
+            Raises:
+                None
+        '''
+        self.net.setInput(cv2.dnn.blobFromImage(frame, scalefactor=1 / 255.0))
+        return list(self.net.forward(self.output_names))
+
+    def release(self):
+        '''
+            This routine releases the network.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.net = None
@@ -0,0 +1,216 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import cv2
+import numpy as np
+
+# Width of the grayscale image the motion is detected on, when the frame
+# given is not already a thumbnail
+MOTION_WIDTH = 160
+
+
+def parseZones(text):
+    '''
+        This routine parses the zones of a config file, given as
+        "x,y,w,h; x,y,w,h" with values relative to the image size (0 to 1).
+
+        Args:
+            text (str): zones of the config file
+
+        Returns:
+            list of tuples (x, y, w, h)
+
+        Raises:
+            Exception: a zone has not 4 values
+    '''
+    zones = []
+    for zone in text.split(';'):
+        if not zone.strip():
+            continue
+        values = [float(v) for v in zone.split(',')]
+        if len(values) != 4:
+            raise Exception(f"Zone {zone} needs to be x,y,w,h")
+        zones.append(tuple(values))
+    return zones
+
+
+def createGate(db):
+    '''
+        This routine creates the gate from the [motion] section of a camera
+        ini (enabled, threshold, min_area, refresh_interval, hold_time and
+        mask_zones).
+
+        Args:
+            db (dict): parameters of the [motion] section, empty if not given
+
+        Returns:
+            MotionGate, or None if not enabled
+
+        Raises:
+            Exception: wrong mask zones
+    '''
+    if not eval(db.get("enabled", "False")):
+        return None
+    return MotionGate(threshold=int(db.get("threshold", 25)),
+                      minArea=float(db.get("min_area", 0.002)),
+                      refreshInterval=float(db.get("refresh_interval", 10.0)),
+                      holdTime=float(db.get("hold_time", 2.0)),
+                      maskZones=parseZones(db.get("mask_zones", "")))
+
+
+class MotionGate:
+    '''
+        This class decides for each frame whether it is worth running the
+        detector on it. The frame is compared against a background, a running
+        average of the previous frames, on a small grayscale image. The
+        detector runs when enough pixels changed, for holdTime seconds after
+        that, and anyway every refreshInterval seconds.
+    '''
+
+    def __init__(self, threshold=25, minArea=0.002, refreshInterval=10.0, holdTime=2.0, learningRate=0.05,
+                 maskZones=None):
+        '''
+            This routine initializes the gate.
+
+            Args:
+                threshold (int): difference of gray level for a pixel to change
+                minArea (float): fraction of the pixels that need to change
+                    to consider there is motion (the lower, the more sensitive)
+                refreshInterval (float): seconds after which the detector runs
+                    even without motion, 0 to never force it
+                holdTime (float): seconds the detector keeps running after the
+                    last motion
+                learningRate (float): weight of each frame in the background
+                maskZones (list): zones (x, y, w, h) relative to the image size
+                    where motion is ignored
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.threshold = threshold
+        self.minArea = minArea
+        self.refreshInterval = refreshInterval
+        self.holdTime = holdTime
+        self.learningRate = learningRate
+        self.maskZones = maskZones if maskZones is not None else []
+        self.motion = 0.0
+        self.passed = 0
+        self.skipped = 0
+        self._background = None
+        self._mask = None
+        self._gray = None
+        self._lastMotion = 0.0
+        self._lastRun = 0.0
+
+    def _prepare(self, image):
+        '''
+            This routine gets the small grayscale image to compare, reducing
+            the image if needed.
+
+            Args:
+                image (ndarray): thumbnail (grayscale) or BGR image
+
+            Returns:
+                grayscale image
+
+            Raises:
+                None
+        '''
+        if image.ndim == 2:
+            return image
+        height = max(1, image.shape[0] * MOTION_WIDTH // image.shape[1])
+        if self._gray is None or self._gray.shape != (height, MOTION_WIDTH):
+            self._gray = np.empty((height, MOTION_WIDTH), dtype=np.uint8)
+        small = cv2.resize(image, (MOTION_WIDTH, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+    def _buildMask(self, shape):
+        '''
+            This routine builds the mask of the pixels watched, all but the
+            ones in the masked zones.
+
+            Args:
+                shape (tuple): shape of the grayscale image
+
+            Returns:
+                mask (ndarray of uint8, 255 where watched)
+
+            Raises:
+                None
+        '''
+        mask = np.full(shape, 255, dtype=np.uint8)
+        height, width = shape
+        for x, y, w, h in self.maskZones:
+            mask[int(y * height):int((y + h) * height), int(x * width):int((x + w) * width)] = 0
+        return mask
+
+    def check(self, image, timestamp=None):
+        '''
+            This routine decides whether the detector runs on the image.
+
+            Args:
+                image (ndarray): thumbnail (grayscale) or BGR image of the frame
+                timestamp (float): time of the frame, now if None
+
+            Returns:
+                True if the detector needs to run
+
+            Raises:
+                None
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        gray = self._prepare(image)
+
+        # the first frame is the background
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray.astype(np.float32)
+            self._mask = self._buildMask(gray.shape)
+            self._lastMotion = timestamp
+        else:
+            diff = cv2.absdiff(gray, cv2.convertScaleAbs(self._background))
+            _, changed = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+            changed = cv2.bitwise_and(changed, self._mask)
+            self.motion = cv2.countNonZero(changed) / changed.size
+            if self.motion >= self.minArea:
+                self._lastMotion = timestamp
+            cv2.accumulateWeighted(gray, self._background, self.learningRate)
+
+        run = timestamp - self._lastMotion <= self.holdTime or \
+            (self.refreshInterval > 0 and timestamp - self._lastRun >= self.refreshInterval)
+        if run:
+            self._lastRun = timestamp
+            self.passed += 1
+        else:
+            self.skipped += 1
+        return run
+
+    def toString(self):
+        '''
+            This routine returns a string with the counters of the gate.
+
+            Args:
+                None
+
+            Returns:
+                string with the frames detected and skipped
+
+            Raises:
+                None
+        '''
+        return f"Frames detected / skipped by motion: {self.passed} / {self.skipped}"
@@ -0,0 +1,257 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cv2
+import numpy as np
+
+# Conversion from the formats delivered by the capture (PyAV names) to BGR.
+# None means the image is already BGR.
+CONVERSIONS_TO_BGR = {
+    'bgr24': None,
+    'rgb24': cv2.COLOR_RGB2BGR,
+    'yuv420p': cv2.COLOR_YUV2BGR_I420,
+    'yuvj420p': cv2.COLOR_YUV2BGR_I420,
+    'nv12': cv2.COLOR_YUV2BGR_NV12,
+    'yuyv422': cv2.COLOR_YUV2BGR_YUYV,
+    'gray': cv2.COLOR_GRAY2BGR,
+}
+
+# Planar formats with the chroma below the luma, the array is 3/2 of the height
+PLANAR_420 = ('yuv420p', 'yuvj420p', 'nv12')
+
+# Value of the padding of the letterboxed image, as in YOLOv5
+LETTERBOX_COLOR = 114
+
+# Names of the levels of the image pyramid, each one half the previous
+PYRAMID_PLANES = ('half', 'quarter')
+
+
+def letterboxParams(width, height, size):
+    '''
+        This routine calculates how an image is fitted into a square of
+        size x size keeping its aspect ratio. A point (x, y) of the letterboxed
+        image is ((x - padX) / scale, (y - padY) / scale) in the original one.
+
+        Args:
+            width (int): width of the original image
+            height (int): height of the original image
+            size (int): side of the letterboxed image
+
+        Returns:
+            tuple (scale, padX, padY, newWidth, newHeight)
+
+        Raises:
+            None
+    '''
+    scale = min(size / width, size / height)
+    newWidth = round(width * scale)
+    newHeight = round(height * scale)
+    padX = (size - newWidth) // 2
+    padY = (size - newHeight) // 2
+    return scale, padX, padY, newWidth, newHeight
+
+
+class Preprocessor:
+    '''
+        This class converts a captured frame once into all the planes the
+        consumers need, writing each one straight into its destination
+        (usually the shared memory):
+            - image: BGR at the destination resolution, for recording, RTSP and view
+            - half, quarter: BGR pyramid of the image, each level reduced from
+              the previous one with cv2.pyrDown
+            - yolo: RGB letterboxed to a square, as input of the detector
+            - thumb: small grayscale image, for motion detection
+        Conversions and resizes that are not needed are skipped, and the
+        yolo and thumb planes are reduced from the smallest pyramid level
+        that is big enough. The intermediate buffers are allocated once and
+        reused.
+    '''
+
+    def __init__(self):
+        '''
+            This routine initializes the preprocessor.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._buffers = {}
+
+    def _buffer(self, name, shape):
+        '''
+            This routine gets an intermediate buffer, allocating it the first
+            time it is needed with that shape. One buffer is kept per shape,
+            so images of a few different sizes (e.g. the tiles and the
+            regions of interest of the detector) all reuse theirs.
+
+            Args:
+                name (str): name of the buffer
+                shape (tuple): shape of the buffer
+
+            Returns:
+                numpy array
+
+            Raises:
+                None
+        '''
+        key = (name, tuple(shape))
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=np.uint8)
+            self._buffers[key] = buf
+        return buf
+
+    def process(self, image, format, planes):
+        '''
+            This routine fills all the planes given from the captured image.
+
+            Args:
+                image (ndarray): image as delivered by the capture
+                format (str): format of the image (PyAV name, e.g. yuv420p, bgr24)
+                planes (dict): destination arrays by name ('image' is required,
+                    'half', 'quarter', 'yolo' and 'thumb' are optional)
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.toBGR(image, format, planes['image'])
+
+        # pyramid levels are built incrementally, each from the previous one
+        src = planes['image']
+        for name in PYRAMID_PLANES:
+            if name not in planes:
+                break
+            dst = planes[name]
+            cv2.pyrDown(src, dst=dst, dstsize=(dst.shape[1], dst.shape[0]))
+            src = dst
+
+        if 'yolo' in planes:
+            scale, padX, padY, newWidth, newHeight = letterboxParams(planes['image'].shape[1], planes['image'].shape[0],
+                                                                     planes['yolo'].shape[0])
+            self.letterbox(self._source(planes, newWidth, newHeight), planes['yolo'])
+        if 'thumb' in planes:
+            self.thumbnail(self._source(planes, planes['thumb'].shape[1], planes['thumb'].shape[0]), planes['thumb'])
+
+    def _source(self, planes, width, height):
+        '''
+            This routine gets the smallest BGR plane at least as big as the
+            size given, to reduce from it.
+
+            Args:
+                planes (dict): planes of the frame
+                width (int): width to reduce to
+                height (int): height to reduce to
+
+            Returns:
+                numpy array of the plane
+
+            Raises:
+                None
+        '''
+        src = planes['image']
+        for name in PYRAMID_PLANES:
+            plane = planes.get(name)
+            if plane is None or plane.shape[1] < width or plane.shape[0] < height:
+                break
+            src = plane
+        return src
+
+    def toBGR(self, image, format, dst):
+        '''
+            This routine converts the image to BGR and resizes it to the
+            shape of dst.
+
+            Args:
+                image (ndarray): image as delivered by the capture
+                format (str): format of the image
+                dst (ndarray): destination, BGR
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        conversion = CONVERSIONS_TO_BGR.get(format, cv2.COLOR_YUV2BGR_YUYV)
+        if conversion is None:
+            img = image
+        else:
+            if format in PLANAR_420:
+                size = (image.shape[0] * 2 // 3, image.shape[1])
+            else:
+                size = image.shape[:2]
+            # same resolution, convert straight into the destination
+            if size == dst.shape[:2]:
+                cv2.cvtColor(image, conversion, dst=dst)
+                return
+            img = cv2.cvtColor(image, conversion, dst=self._buffer('bgr', size + (3,)))
+
+        if img.shape == dst.shape:
+            np.copyto(dst, img)
+        else:
+            cv2.resize(img, (dst.shape[1], dst.shape[0]), dst=dst)
+
+    def letterbox(self, src, dst):
+        '''
+            This routine letterboxes the BGR image into the square RGB dst.
+
+            Args:
+                src (ndarray): BGR image
+                dst (ndarray): destination, square RGB
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        scale, padX, padY, newWidth, newHeight = letterboxParams(src.shape[1], src.shape[0], dst.shape[0])
+        if (newWidth, newHeight) == (src.shape[1], src.shape[0]):
+            resized = src
+        else:
+            resized = cv2.resize(src, (newWidth, newHeight), dst=self._buffer('letterbox', (newHeight, newWidth, 3)))
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=dst[padY:padY + newHeight, padX:padX + newWidth])
+
+        # only the borders are padded, the rest was just written
+        dst[:padY] = LETTERBOX_COLOR
+        dst[padY + newHeight:] = LETTERBOX_COLOR
+        dst[:, :padX] = LETTERBOX_COLOR
+        dst[:, padX + newWidth:] = LETTERBOX_COLOR
+
+    def thumbnail(self, src, dst):
+        '''
+            This routine reduces the BGR image to the grayscale dst. The image
+            is reduced before converting, so the conversion works on few pixels.
+
+            Args:
+                src (ndarray): BGR image
+                dst (ndarray): destination, grayscale
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        small = cv2.resize(src, (dst.shape[1], dst.shape[0]), dst=self._buffer('thumb', dst.shape + (3,)),
+                           interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=dst)
@@ -14,30 +14,118 @@
 
 import io
 from multiprocessing import shared_memory
-import threading
+import ctypes
+import platform
+import time
 import cv2
 import numpy as np
 import logging
+import preprocess
 
 # Constants definition
 MAX_SHM_ITEMS = 100
 INDEX_BASE = 0
-INDEX_IMAGE = INDEX_BASE + 0
-INDEX_IMAGE_SHAPE = INDEX_BASE + 1
-INDEX_IMAGE_FORMAT = INDEX_BASE + 2
-INDEX_BOXES = INDEX_BASE + 3
-INDEX_YOLO_FLAG = INDEX_BASE + 4
-INDEX_RECORD_FLAG = INDEX_BASE + 5
-INDEX_CAPTURE_FLAG = INDEX_BASE + 6
-INDEX_VIEW_FLAG = INDEX_BASE + 7
-INDEX_MARKER_FLAG = INDEX_BASE + 8
-INDEX_PIPE_FLAG = INDEX_BASE + 9
-INDEX_RUN_FLAG = INDEX_BASE + 10
-INDEX_EXIT_FLAG = INDEX_BASE + 11
-
-# Semaphore for accesing resources: image data
-sem_image = threading.Semaphore(1)
-sem_boxes = threading.Semaphore(1)
+INDEX_IMAGE_SHAPE = INDEX_BASE + 0
+INDEX_IMAGE_FORMAT = INDEX_BASE + 1
+INDEX_MAX_BOXES = INDEX_BASE + 2
+INDEX_FRAME_SLOTS = INDEX_BASE + 3
+INDEX_YOLO_SIZE = INDEX_BASE + 4
+INDEX_THUMB_WIDTH = INDEX_BASE + 5
+INDEX_PYRAMID_LEVELS = INDEX_BASE + 6
+
+# Control flags, packed as bits of a single word in the header of the raw
+# block. Every change increments the flags version in the header.
+FLAG_YOLO = 1 << 0
+FLAG_RECORD = 1 << 1
+FLAG_CAPTURE = 1 << 2
+FLAG_VIEW = 1 << 3
+FLAG_MARKER = 1 << 4
+FLAG_PIPE = 1 << 5
+FLAG_RUN = 1 << 6
+FLAG_EXIT = 1 << 7
+
+# The images are not part of the shareable list. They live in their own raw
+# shared memory block, named as the list plus this suffix.
+SHM_IMAGE_SUFFIX = "_img"
+
+# Layout of the raw block: a header of 64 bit words, a table with one entry
+# per frame slot and then the frames themselves. Each frame slot holds the
+# planes of the frame (the image and the optional pyramid, yolo and thumb
+# planes, see preprocess.Preprocessor), each one aligned to SHM_ALIGN. The
+# header also keeps the health of the video source as reported by the capture
+# (HEADER_LAST_FRAME_TIME holds a float64).
+SHM_ALIGN = 64
+HEADER_WORDS = 16
+HEADER_LATEST_SEQ = 0
+HEADER_TORN_READS = 1
+HEADER_BOXES_GEN = 2
+HEADER_BOXES_COUNT = 3
+HEADER_FLAGS = 4
+HEADER_FLAGS_VERSION = 5
+HEADER_FUTEX = 6
+HEADER_STREAM_CONNECTED = 7
+HEADER_RECONNECTS = 8
+HEADER_DECODE_ERRORS = 9
+HEADER_LAST_FRAME_TIME = 10
+SLOT_DTYPE = np.dtype([('gen', '<u8'), ('seq', '<u8'), ('timestamp', '<f8')])
+
+# Frames are protected by a seqlock: the writer makes the generation counter
+# of the slot odd while writing and even when done. A reader that sees the
+# counter odd, or changed after copying, got a torn frame and retries.
+SEQLOCK_MAX_RETRIES = 3
+
+# Processes waiting for a new frame or a change of the flags sleep on a futex,
+# a 32 bit counter in the header (word HEADER_FUTEX) that the writer increments
+# before waking them up. Where the futex syscall is not available, the waiting
+# falls back to polling every FUTEX_POLL_INTERVAL seconds.
+FUTEX_FRAME = 0
+FUTEX_FLAGS = 1
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+FUTEX_POLL_INTERVAL = 0.005
+FUTEX_SYSCALLS = {'x86_64': 202, 'aarch64': 98, 'armv7l': 240, 'armv6l': 240, 'i686': 240}
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _futexSyscall():
+    '''
+        This routine gets the libc syscall function and the number of the
+        futex syscall for this machine.
+
+        Args:
+            None
+
+        Returns:
+            tuple (syscall function, futex syscall number), or (None, None) if
+            futex is not available
+
+        Raises:
+            None
+    '''
+    if platform.system() != 'Linux' or platform.machine() not in FUTEX_SYSCALLS:
+        return None, None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        syscall = libc.syscall
+        syscall.restype = ctypes.c_long
+    except Exception as e:
+        logging.warning(f"futex not available, falling back to polling: {e}")
+        return None, None
+    return syscall, FUTEX_SYSCALLS[platform.machine()]
+
+
+_syscall, _SYS_futex = _futexSyscall()
+
+# Objects detected are kept in a table of fixed size records. The boxes
+# refer to the frame (seq) on which they were detected. The table is
+# protected with a seqlock as the frames, with the generation counter in
+# the header.
+BOX_DTYPE = np.dtype([('x', '<i4'), ('y', '<i4'), ('w', '<i4'), ('h', '<i4'),
+                      ('class_id', '<i4'), ('confidence', '<f4'), ('color', '<i4'),
+                      ('track_id', '<i4'), ('seq', '<u8'), ('label', 'S32')])
 
 class SHMCAM:
     '''
@@ -45,7 +133,8 @@ class SHMCAM:
         such as capture, view, recording can access to perform their jobs.
     '''
 
-    def __init__(self, create=False, name=None, maxImageWidth=1920, maxImageHeight=1080, maxImageDepth=3, maxBoxes=100):
+    def __init__(self, create=False, name=None, maxImageWidth=1920, maxImageHeight=1080, maxImageDepth=3, maxBoxes=100, frameSlots=4,
+                 yoloSize=0, thumbWidth=0, pyramidLevels=0):
         '''
             This routine initializes the object shared memory.
 
@@ -56,6 +145,11 @@ class SHMCAM:
                 maxImageHeight (int): space for the image height in pixels
                 maxImageDepth (int): depth of the image stored (3 for RGB)
                 maxBoxes (int): number of objects that can be identified in the image
+                frameSlots (int): number of frames kept in the ring buffer
+                yoloSize (int): side of the letterboxed RGB plane for the detector, 0 for none
+                thumbWidth (int): width of the grayscale thumbnail plane, 0 for none
+                pyramidLevels (int): number of reduced planes of the image kept
+                    (half, quarter), up to len(preprocess.PYRAMID_PLANES)
 
             Returns:
                 shared memory object
@@ -64,43 +158,41 @@ class SHMCAM:
                 None
         '''
         self._shm = None
+        self._shmImage = None
+        self._header = None
+        self._slots = None
+        self._frames = None
+        self._planes = None
+        self._boxes = None
+        self._futex = None
+        self._preprocessor = None
+        self.maxRetries = SEQLOCK_MAX_RETRIES
+        self.tornReads = 0
         self.maxBoxes = maxBoxes
         self.maxImageWidth = maxImageWidth
         self.maxImageHeight = maxImageHeight
         self.maxImageDepth = maxImageDepth
+        self.frameSlots = frameSlots
+        self.yoloSize = yoloSize
+        self.thumbWidth = thumbWidth
+        self.pyramidLevels = min(pyramidLevels, len(preprocess.PYRAMID_PLANES))
 
         # if we need to create the Shared Memory space
         if create:
 
             # Create space for the variables
-            image = b'\x00' * maxImageWidth * maxImageHeight * maxImageDepth # maximum size that can the image be
             imageShape = "({v1:d}, {v2:d}, {v3:d})".format(v1=maxImageWidth, v2=maxImageHeight, v3=maxImageDepth)
-            imageFormat = "RGB24" #"This is the test Format"
-            itemBox = "[ [ XXXX, YYYY, WWWW, HHHH ], 'This is the label of the box to display', 'X.XX', 'This is the color of the label' ], "
-            boxes = "[ " + " " * len(itemBox) * maxBoxes + " ]"
-            yoloFlag = False
-            recordFlag = False
-            captureFlag = False
-            viewFlag = False
-            markerFlag = False  # Flag to allow marking the image as post processing from YOLO.
-            pipeFlag = False
-            runFlag = False
-            exitFlag = False
+            imageFormat = "BGR24" #"This is the test Format"
 
             # Populate the list to be shareable
             sList = [ 0 ] * MAX_SHM_ITEMS
-            sList[INDEX_IMAGE] = image
             sList[INDEX_IMAGE_SHAPE] = imageShape
             sList[INDEX_IMAGE_FORMAT] = imageFormat
-            sList[INDEX_BOXES] = boxes
-            sList[INDEX_YOLO_FLAG] = yoloFlag
-            sList[INDEX_RECORD_FLAG] = recordFlag
-            sList[INDEX_CAPTURE_FLAG] = captureFlag
-            sList[INDEX_VIEW_FLAG] = viewFlag
-            sList[INDEX_MARKER_FLAG] = markerFlag
-            sList[INDEX_PIPE_FLAG] = pipeFlag
-            sList[INDEX_RUN_FLAG] = runFlag
-            sList[INDEX_EXIT_FLAG] = exitFlag
+            sList[INDEX_MAX_BOXES] = maxBoxes
+            sList[INDEX_FRAME_SLOTS] = frameSlots
+            sList[INDEX_YOLO_SIZE] = yoloSize
+            sList[INDEX_THUMB_WIDTH] = thumbWidth
+            sList[INDEX_PYRAMID_LEVELS] = self.pyramidLevels
 
             if name is None:
                 # this is the list for the Shared Memory
@@ -109,18 +201,382 @@ class SHMCAM:
                 # this is the list for the Shared Memory
                 self._shm = shared_memory.ShareableList(sList, name=name)
 
-            # after creation, initialize boxes to [ ]
-            self.setBoxes([])
+            # the images are kept in a raw block, so that they can be written
+            # and read in place as numpy arrays
+            self._shmImage = shared_memory.SharedMemory(create=True,
+                                                        size=self._layout()[1],
+                                                        name=self._shm.shm.name + SHM_IMAGE_SUFFIX)
+
             self.setImageShape((maxImageWidth, maxImageHeight, maxImageDepth))
-            self.setImageFormat('RGB24')
+            self.setImageFormat('BGR24')
 
         # attach to existing one
         else:
             self._shm = shared_memory.ShareableList(name=name)
+            self._shmImage = shared_memory.SharedMemory(name=self._shm.shm.name + SHM_IMAGE_SUFFIX)
+
+            self.maxImageWidth, self.maxImageHeight, self.maxImageDepth = self.getImageShape()
+            self.maxBoxes = self._shm[INDEX_MAX_BOXES]
+            self.frameSlots = self._shm[INDEX_FRAME_SLOTS]
+            self.yoloSize = self._shm[INDEX_YOLO_SIZE]
+            self.thumbWidth = self._shm[INDEX_THUMB_WIDTH]
+            self.pyramidLevels = self._shm[INDEX_PYRAMID_LEVELS]
+
+        self._mapLayout()
+
+    @staticmethod
+    def _align(size):
+        return (size + SHM_ALIGN - 1) // SHM_ALIGN * SHM_ALIGN
+
+    def _planeShapes(self):
+        '''
+            This routine gets the array shape of each plane of a frame slot.
+            Shape is stored as (width, height, depth) while the arrays are
+            (height, width, depth).
+
+            Args:
+                None
+
+            Returns:
+                dictionary of shapes by plane name
+
+            Raises:
+                None
+        '''
+        shapes = {'image': (self.maxImageHeight, self.maxImageWidth, self.maxImageDepth)}
+        height, width = self.maxImageHeight, self.maxImageWidth
+        for name in preprocess.PYRAMID_PLANES[:self.pyramidLevels]:
+            # size given by cv2.pyrDown
+            height, width = (height + 1) // 2, (width + 1) // 2
+            shapes[name] = (height, width, self.maxImageDepth)
+        if self.yoloSize > 0:
+            shapes['yolo'] = (self.yoloSize, self.yoloSize, 3)
+        if self.thumbWidth > 0:
+            shapes['thumb'] = (max(1, round(self.thumbWidth * self.maxImageHeight / self.maxImageWidth)), self.thumbWidth)
+        return shapes
+
+    def _layout(self):
+        '''
+            This routine calculates where each area of the raw block starts.
+
+            Args:
+                None
+
+            Returns:
+                tuple with a dictionary of offsets per area and the total size
+                in bytes
+
+            Raises:
+                None
+        '''
+        offsets = {}
+        offsets['header'] = 0
+        offsets['slots'] = HEADER_WORDS * 8
+        offsets['boxes'] = self._align(offsets['slots'] + self.frameSlots * SLOT_DTYPE.itemsize)
+        offsets['frames'] = self._align(offsets['boxes'] + self.maxBoxes * BOX_DTYPE.itemsize)
+        slotSize = sum(self._align(int(np.prod(s))) for s in self._planeShapes().values())
+        return offsets, offsets['frames'] + self.frameSlots * slotSize
+
+    def _mapLayout(self):
+        '''
+            This routine maps the header, slot table, boxes table and frames of
+            the raw block as numpy arrays.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        buf = self._shmImage.buf
+        offsets, size = self._layout()
+        self._header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=buf, offset=offsets['header'])
+        self._slots = np.ndarray((self.frameSlots,), dtype=SLOT_DTYPE, buffer=buf, offset=offsets['slots'])
+        self._boxes = np.ndarray((self.maxBoxes,), dtype=BOX_DTYPE, buffer=buf, offset=offsets['boxes'])
+        self._futex = np.ndarray((2,), dtype=np.uint32, buffer=buf, offset=offsets['header'] + HEADER_FUTEX * 8)
+        self._headerTimes = self._header.view(np.float64)
+
+        offset = offsets['frames']
+        self._planes = []
+        for i in range(self.frameSlots):
+            planes = {}
+            for name, shape in self._planeShapes().items():
+                planes[name] = np.ndarray(shape, dtype=np.uint8, buffer=buf, offset=offset)
+                offset += self._align(int(np.prod(shape)))
+            self._planes.append(planes)
+        self._frames = [planes['image'] for planes in self._planes]
+
+    def getPlaneNames(self):
+        '''
+            This routine gets the names of the planes stored for every frame.
+
+            Args:
+                None
+
+            Returns:
+                list of plane names ('image', 'half', 'quarter', 'yolo', 'thumb')
+
+            Raises:
+                None
+        '''
+        return list(self._planes[0].keys())
+
+    def getPlaneShape(self, plane='image'):
+        '''
+            This routine gets the array shape of a plane.
+
+            Args:
+                plane (str): name of the plane
+
+            Returns:
+                shape as (height, width, depth) or (height, width)
+
+            Raises:
+                KeyError: the plane is not stored
+        '''
+        return self._planes[0][plane].shape
+
+    def getLetterbox(self):
+        '''
+            This routine gets how the image is letterboxed into the yolo plane.
+
+            Args:
+                None
+
+            Returns:
+                tuple (scale, padX, padY, newWidth, newHeight), see
+                preprocess.letterboxParams(). None if there is no yolo plane
+
+            Raises:
+                None
+        '''
+        if self.yoloSize <= 0:
+            return None
+        return preprocess.letterboxParams(self.maxImageWidth, self.maxImageHeight, self.yoloSize)
+
+    def _futexWait(self, index, value, timeout):
+        '''
+            This routine sleeps while the futex counter keeps the given value,
+            at most timeout seconds.
+
+            Args:
+                index (int): futex counter (FUTEX_FRAME, FUTEX_FLAGS)
+                value (int): value of the counter read by the caller
+                timeout (float): maximum seconds to wait
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        if _syscall is None:
+            time.sleep(min(timeout, FUTEX_POLL_INTERVAL))
+            return
+
+        ts = _timespec(int(timeout), int((timeout % 1) * 1e9))
+        # returns on wake up, timeout, signal or if the value already changed
+        _syscall(_SYS_futex, ctypes.c_void_p(self._futex.ctypes.data + index * 4),
+                 FUTEX_WAIT, ctypes.c_uint32(value), ctypes.byref(ts), None, 0)
+
+    def _futexWake(self, index):
+        '''
+            This routine increments the futex counter and wakes up all processes
+            waiting on it.
+
+            Args:
+                index (int): futex counter (FUTEX_FRAME, FUTEX_FLAGS)
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._futex[index] += 1
+        if _syscall is not None:
+            _syscall(_SYS_futex, ctypes.c_void_p(self._futex.ctypes.data + index * 4),
+                     FUTEX_WAKE, ctypes.c_int(0x7fffffff), None, None, 0)
+
+    def waitForNewFrame(self, lastSeq, timeout=None):
+        '''
+            This routine waits until a frame newer than lastSeq is stored. It
+            also returns as soon as the exit flag is set, so that modules waiting
+            can close.
+
+            Args:
+                lastSeq (int): sequence number of the last frame processed
+                timeout (float): maximum seconds to wait, forever if None
+
+            Returns:
+                sequence number of the last frame stored. It is lastSeq if
+                the wait timed out
+
+            Raises:
+                None
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            value = int(self._futex[FUTEX_FRAME])
+            seq = self.getLatestSeq()
+            if seq > lastSeq or self.getFlags() & FLAG_EXIT:
+                return seq
+            remaining = 1.0 if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                return seq
+            self._futexWait(FUTEX_FRAME, value, remaining)
+
+    def getLatestSeq(self):
+        '''
+            This routine gets the sequence number of the last frame stored.
+            Sequence numbers start at 1, 0 means no frame stored yet.
+
+            Args:
+                None
+
+            Returns:
+                sequence number of the last frame
+
+            Raises:
+                None
+        '''
+        return int(self._header[HEADER_LATEST_SEQ])
+
+    def getTornReads(self):
+        '''
+            This routine gets the number of torn frames detected by all readers
+            of the shared memory. The counter is updated without lock by
+            every reader, so it is an approximation.
+
+            Args:
+                None
+
+            Returns:
+                number of torn reads
+
+            Raises:
+                None
+        '''
+        return int(self._header[HEADER_TORN_READS])
+
+    def getStreamHealth(self):
+        '''
+            This routine gets the health of the video source, as reported by
+            the capture module.
+
+            Args:
+                None
+
+            Returns:
+                dict with connected (bool), reconnects (int), decode_errors (int)
+                and since_last_frame (float, seconds since the last frame was
+                decoded, None if no frame decoded yet)
+
+            Raises:
+                None
+        '''
+        lastFrameTime = float(self._headerTimes[HEADER_LAST_FRAME_TIME])
+        return {
+            'connected': bool(self._header[HEADER_STREAM_CONNECTED]),
+            'reconnects': int(self._header[HEADER_RECONNECTS]),
+            'decode_errors': int(self._header[HEADER_DECODE_ERRORS]),
+            'since_last_frame': time.time() - lastFrameTime if lastFrameTime > 0 else None,
+        }
+
+    def checkFrame(self, seq):
+        '''
+            This routine checks that the frame with the given sequence number
+            is still in the ring buffer and not being overwritten. It is meant
+            for readers using views, to validate the frame after using it.
+
+            Args:
+                seq (int): sequence number of the frame
+
+            Returns:
+                True if the frame is still valid
+
+            Raises:
+                None
+        '''
+        slot = seq % len(self._frames)
+        return (int(self._slots['gen'][slot]) & 1) == 0 and int(self._slots['seq'][slot]) == seq
+
+    def getFrame(self, seq, copy=True, out=None, plane='image'):
+        '''
+            This routine gets the frame with the given sequence number, if
+            it is still in the ring buffer. The frame is read following the
+            seqlock protocol, retrying up to maxRetries times if torn.
+
+            Args:
+                seq (int): sequence number of the frame
+                copy (bool): return a copy (True) or a view on the shared memory.
+                    A view can be validated later with checkFrame()
+                out (ndarray): preallocated array where to copy the frame
+                plane (str): plane of the frame to get (see getPlaneNames())
+
+            Returns:
+                tuple (seq, timestamp, image), or None if the frame is not
+                available (not yet captured, already overwritten or torn)
+
+            Raises:
+                None
+        '''
+        if seq <= 0 or seq > self.getLatestSeq():
+            return None
+
+        slot = seq % len(self._frames)
+        gens = self._slots['gen']
+        for i in range(self.maxRetries + 1):
+            gen = int(gens[slot])
+            if int(self._slots['seq'][slot]) != seq:
+                return None
+            if (gen & 1) == 0:
+                timestamp = float(self._slots['timestamp'][slot])
+                src = self._planes[slot][plane]
+                if out is not None:
+                    np.copyto(out, src)
+                    img = out
+                elif copy:
+                    img = src.copy()
+                else:
+                    img = src
+                if int(gens[slot]) == gen and int(self._slots['seq'][slot]) == seq:
+                    return seq, timestamp, img
+
+            # the writer was on this slot
+            self.tornReads += 1
+            self._header[HEADER_TORN_READS] += 1
+
+        return None
+
+    def getLatestFrame(self, copy=True, out=None, plane='image'):
+        '''
+            This routine gets the last frame stored.
+
+            Args:
+                copy (bool): return a copy (True) or a view on the shared memory
+                out (ndarray): preallocated array where to copy the frame
+                plane (str): plane of the frame to get (see getPlaneNames())
+
+            Returns:
+                tuple (seq, timestamp, image). If no frame is stored yet,
+                it is (0, 0.0, None)
+
+            Raises:
+                None
+        '''
+        frame = self.getFrame(self.getLatestSeq(), copy=copy, out=out, plane=plane)
+        if frame is None:
+            return 0, 0.0, None
+        return frame
 
     def getImage(self):
         '''
-            This routine gets image. Image is stored as serialized bytes
+            This routine gets a copy of the last image. Use this when the image
+            is to be modified (e.g. marking boxes on it).
 
             Args:
                 None
@@ -131,23 +587,27 @@ class SHMCAM:
             Raises:
                 None
         '''
-        imageCorrect = False
-        i=0
+        seq, timestamp, img = self.getLatestFrame()
+        if img is None:
+            img = np.zeros_like(self._frames[0])
+        return img
 
-#        print(f"(getImage) ENTERING mutual exclusion zone")
-        sem_image.acquire()
-        try:
-            while not imageCorrect:
-                img = np.frombuffer(self._shm[INDEX_IMAGE], dtype=np.uint8)
-                shape = self.getImageShape()
-                imageCorrect = (img.size * img.itemsize == shape[0] * shape[1] * shape[2])
+    def getImageView(self):
+        '''
+            This routine gets the last image as a view on the shared memory. No copy
+            is done, so the content changes when the slot is reused by a new
+            image. The view must not be modified.
 
-            img = np.reshape(img, newshape=(shape[1], shape[0], shape[2]))
-        except Exception as e:
-            print(f"(getImage) Exception while getting image: {e}")
-#        print(f"(getImage) EXITING mutual exclusion zone")
-        sem_image.release()
-        return img
+            Args:
+                None
+
+            Returns:
+                numpy array mapped on the image in shared memory
+
+            Raises:
+                None
+        '''
+        return self._frames[self.getLatestSeq() % len(self._frames)]
 
     def getImageShape(self):
         '''
@@ -180,6 +640,51 @@ class SHMCAM:
         '''
         return self._shm[INDEX_IMAGE_FORMAT]
     
+    def getBoxesCount(self):
+        '''
+            This routine gets the number of objects in the boxes table.
+
+            Args:
+                None
+
+            Returns:
+                number of objects detected
+
+            Raises:
+                None
+        '''
+        return int(self._header[HEADER_BOXES_COUNT])
+
+    def getBoxesArray(self, copy=False):
+        '''
+            This routine gets the objects detected as a record array with
+            the fields of BOX_DTYPE (x, y, w, h, class_id, confidence, color,
+            seq, label).
+
+            Args:
+                copy (bool): return a copy read following the seqlock protocol
+                    (True) or a view on the shared memory (False)
+
+            Returns:
+                array of boxes. Empty if no consistent copy could be read
+
+            Raises:
+                None
+        '''
+        if not copy:
+            return self._boxes[:self.getBoxesCount()]
+
+        for i in range(self.maxRetries + 1):
+            gen = int(self._header[HEADER_BOXES_GEN])
+            if (gen & 1) == 0:
+                boxes = self._boxes[:self.getBoxesCount()].copy()
+                if int(self._header[HEADER_BOXES_GEN]) == gen:
+                    return boxes
+            self.tornReads += 1
+            self._header[HEADER_TORN_READS] += 1
+
+        return np.zeros(0, dtype=BOX_DTYPE)
+
     def getBoxes(self):
         '''
             This routine gets objects in the image stored.
@@ -188,21 +693,82 @@ class SHMCAM:
                 None
 
             Returns:
-                image shape
+                list of boxes in the form [ [x, y, w, h], label, confidence, color, class_id, track_id ].
+                track_id is -1 if the objects are not tracked
 
             Raises:
                 None
         '''
-        sem_boxes.acquire()
-        try:
-            b = eval(self._shm[INDEX_BOXES])
-        except Exception as e:
-            logging.error(f"Exception when evaluating {self._shm[INDEX_BOXES]} *** " + str(e))
-            b = []
-        finally:
-            sem_boxes.release()
+        b = []
+        for r in self.getBoxesArray(copy=True):
+            b.append([[int(r['x']), int(r['y']), int(r['w']), int(r['h'])],
+                      r['label'].decode(),
+                      round(float(r['confidence']), 2),
+                      int(r['color']),
+                      int(r['class_id']),
+                      int(r['track_id'])])
         return b
 
+    def getFlags(self):
+        '''
+            This routine gets a snapshot of all control flags, to be tested
+            with the FLAG_* masks.
+
+            Args:
+                None
+
+            Returns:
+                word with the flags
+
+            Raises:
+                None
+        '''
+        return int(self._header[HEADER_FLAGS])
+
+    def getFlagsVersion(self):
+        '''
+            This routine gets the version of the flags, incremented on every
+            change.
+
+            Args:
+                None
+
+            Returns:
+                version of the flags
+
+            Raises:
+                None
+        '''
+        return int(self._header[HEADER_FLAGS_VERSION])
+
+    def waitForFlags(self, mask, timeout=None):
+        '''
+            This routine waits until all flags in mask are set. It also returns
+            as soon as the exit flag is set, so that modules waiting can close.
+
+            Args:
+                mask (int): FLAG_* masks to wait for
+                timeout (float): maximum seconds to wait, forever if None
+
+            Returns:
+                snapshot of the flags when returning. The caller needs to check
+                them, as the wait could have timed out
+
+            Raises:
+                None
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            value = int(self._futex[FUTEX_FLAGS])
+            flags = self.getFlags()
+            if (flags & mask) == mask or (flags & FLAG_EXIT):
+                return flags
+            remaining = 1.0 if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                return flags
+            # nothing to do until someone changes the flags
+            self._futexWait(FUTEX_FLAGS, value, remaining)
+
     def getYoloFlag(self):
         '''
             This routine gets flag for allowing YOLO detector.
@@ -216,7 +782,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_YOLO_FLAG]
+        return bool(self.getFlags() & FLAG_YOLO)
     
     def getRecordFlag(self):
         '''
@@ -231,7 +797,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_RECORD_FLAG]
+        return bool(self.getFlags() & FLAG_RECORD)
     
     def getCaptureFlag(self):
         '''
@@ -246,7 +812,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_CAPTURE_FLAG]
+        return bool(self.getFlags() & FLAG_CAPTURE)
     
     def getViewFlag(self):
         '''
@@ -261,7 +827,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_VIEW_FLAG]
+        return bool(self.getFlags() & FLAG_VIEW)
     
     def getMarkFlag(self):
         '''
@@ -276,7 +842,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_MARKER_FLAG]
+        return bool(self.getFlags() & FLAG_MARKER)
     
     def getPipeFlag(self):
         '''
@@ -291,7 +857,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_PIPE_FLAG]
+        return bool(self.getFlags() & FLAG_PIPE)
     
     def getRunFlag(self):
         '''
@@ -306,7 +872,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_RUN_FLAG]
+        return bool(self.getFlags() & FLAG_RUN)
 
     def getExitFlag(self):
         '''
@@ -321,55 +887,118 @@ class SHMCAM:
             Raises:
                 None
         '''
-        return self._shm[INDEX_EXIT_FLAG]
+        return bool(self.getFlags() & FLAG_EXIT)
 
 #
     #   IMAGE NEEDS TO BE OF A SPECIFIC FORMAT. IT IS PROBABLY BETTER TO HAVE A SPECIFIC FORMAT AS ENTRY.
     #
-    def setImage(self, image, format):
+    def setImage(self, image, format, timestamp=None):
         '''
-            This routine set the image.
+            This routine stores the image in the next slot of the ring buffer,
+            filling all its planes (see preprocess.Preprocessor).
 
             Args:
                 image (cv2 image): image to store in shared memory
-                format (str): format of the image to store
+                format (str): format of the image to store (PyAV name, e.g.
+                    yuv420p, bgr24)
+                timestamp (float): capture time, now if None
 
             Returns:
-                None
+                sequence number of the last image stored
 
             Raises:
                 None
         '''
         assert isinstance(image, np.ndarray)
 
-        # the storage of the image is predefined.
-        # if not the same shape, then resize
-        # and turn to RGB24
-        if format == 'yuv420p':
-            conversion = cv2.COLOR_YUV420p2RGB
-        elif format == 'yuyv422':
-#            conversion = cv2.COLOR_YUV2BGR_YUYV
-            conversion = cv2.COLOR_YUV2RGB_YUYV
-        elif format == 'rgb24':
-            conversion = None
-        else:
-            conversion = cv2.COLOR_YUV2BGR_YUYV
-
-        if conversion is not None:
-            img = cv2.cvtColor(image, conversion)
-        else:
-            img = image
-        shape = self.getImageShape()
-        img = cv2.resize(img, (shape[0], shape[1]))
-
-#        print(f"(setImage) ENTERING the mutual exclusion zone")
-        sem_image.acquire()
+        if timestamp is None:
+            timestamp = time.time()
+        if self._preprocessor is None:
+            self._preprocessor = preprocess.Preprocessor()
+
+        # the preprocessor writes every plane straight into the next slot of
+        # the shared memory, converting and resizing only when needed. Only
+        # the capture module writes, so the sequence number is not contended.
+        # The generation counter of the slot is odd while writing (seqlock)
+        seq = self.getLatestSeq() + 1
+        slot = seq % len(self._frames)
+        gens = self._slots['gen']
+        gens[slot] += 1
         try:
-            self._shm[INDEX_IMAGE] = img.tobytes()
+            self._preprocessor.process(image, format, self._planes[slot])
+            self._slots['seq'][slot] = seq
+            self._slots['timestamp'][slot] = timestamp
+            gens[slot] += 1
+            self._header[HEADER_LATEST_SEQ] = seq
+            self._futexWake(FUTEX_FRAME)
         except Exception as e:
-            print(f"(setImage) Error translating image to bytes")
-#        print(f"(setImage) EXITING the mutual exclusion zone")
-        sem_image.release()
+            # leave the slot as not valid
+            self._slots['seq'][slot] = 0
+            gens[slot] += 1
+            logging.error(f"(setImage) Error storing image: {e}")
+
+        return self.getLatestSeq()
+
+    def setStreamConnected(self, connected):
+        '''
+            This routine sets whether the video source is connected.
+
+            Args:
+                connected (bool): True if the source is connected
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._header[HEADER_STREAM_CONNECTED] = 1 if connected else 0
+
+    def countReconnect(self):
+        '''
+            This routine counts an attempt to reconnect to the video source.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._header[HEADER_RECONNECTS] += 1
+
+    def countDecodeError(self):
+        '''
+            This routine counts an error reading or decoding the video source.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._header[HEADER_DECODE_ERRORS] += 1
+
+    def setLastFrameTime(self, timestamp=None):
+        '''
+            This routine sets the time the last frame was decoded, published
+            or not.
+
+            Args:
+                timestamp (float): time of the frame, now if None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self._headerTimes[HEADER_LAST_FRAME_TIME] = time.time() if timestamp is None else timestamp
 
     def setImageShape(self, shape):
         '''
@@ -402,12 +1031,15 @@ class SHMCAM:
         '''
         self._shm[INDEX_IMAGE_FORMAT] = format
 
-    def setBoxes(self, boxes):
+    def setBoxes(self, boxes, seq=0):
         '''
-            This routine set the image.
+            This routine set the objects detected in a frame. Boxes exceeding
+            maxBoxes are discarded.
 
             Args:
-                boxes (list): list of boxes in form [ (x, y, w, h), label, color ]
+                boxes (list): list of boxes in form [ [x, y, w, h], label, confidence, color, class_id, track_id ].
+                    class_id and track_id are optional
+                seq (int): sequence number of the frame where the boxes were detected
 
             Returns:
                 None
@@ -416,16 +1048,57 @@ class SHMCAM:
                 None
         '''
         # Format of the alist should be as from the outcome of the YOLO Algorithm
-        # [ [ [x, y, w, h], label, confidence, color], [[x, y, w, h], label, confidence, color], ... ]
+        # [ [ [x, y, w, h], label, confidence, color, class_id, track_id], ... ]
         assert isinstance(boxes, list)
-        sem_boxes.acquire()
+        if len(boxes) > self.maxBoxes:
+            logging.warning(f"Too many boxes ({len(boxes)}), keeping {self.maxBoxes}")
+            boxes = boxes[:self.maxBoxes]
+
+        # seqlock on the whole table
+        self._header[HEADER_BOXES_GEN] += 1
         try:
-            self._shm[INDEX_BOXES] = str(boxes)
+            for i, box in enumerate(boxes):
+                r = self._boxes[i]
+                r['x'], r['y'], r['w'], r['h'] = box[0]
+                r['label'] = str(box[1]).encode()[:BOX_DTYPE['label'].itemsize]
+                r['confidence'] = box[2]
+                r['color'] = box[3] if isinstance(box[3], int) else 0
+                r['class_id'] = box[4] if len(box) > 4 else -1
+                r['track_id'] = box[5] if len(box) > 5 else -1
+                r['seq'] = seq
+            self._header[HEADER_BOXES_COUNT] = len(boxes)
         except Exception as e:
-            logging.error(f"Exception when evaluating {boxes} *** " + str(e))
-            self._shm[INDEX_BOXES] = "[]"
+            logging.error(f"Exception when storing {boxes} *** " + str(e))
+            self._header[HEADER_BOXES_COUNT] = 0
         finally:
-            sem_boxes.release()
+            self._header[HEADER_BOXES_GEN] += 1
+
+    def setFlags(self, mask, value):
+        '''
+            This routine sets or clears the flags in mask. Flags are meant to be
+            set from a single module (camera_main), as the update is not atomic
+            among several writers.
+
+            Args:
+                mask (int): FLAG_* masks to change
+                value (bool): set (True) or clear (False) the flags
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        flags = self.getFlags()
+        if value:
+            flags |= mask
+        else:
+            flags &= ~mask
+        self._header[HEADER_FLAGS] = flags
+        self._header[HEADER_FLAGS_VERSION] += 1
+        self._futexWake(FUTEX_FLAGS)
+        # frame waiters need to see the exit flag too
+        self._futexWake(FUTEX_FRAME)
 
     def setYoloFlag(self, flag):
         '''
@@ -441,7 +1114,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_YOLO_FLAG] = flag
+        self.setFlags(FLAG_YOLO, flag)
 
     def setRecordFlag(self, flag):
         '''
@@ -457,7 +1130,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_RECORD_FLAG] = flag
+        self.setFlags(FLAG_RECORD, flag)
 
     def setCaptureFlag(self, flag):
         '''
@@ -473,7 +1146,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_CAPTURE_FLAG] = flag
+        self.setFlags(FLAG_CAPTURE, flag)
 
     def setViewFlag(self, flag):
         '''
@@ -489,7 +1162,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_VIEW_FLAG] = flag
+        self.setFlags(FLAG_VIEW, flag)
 
     def setMarkFlag(self, flag):
         '''
@@ -505,7 +1178,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_MARKER_FLAG] = flag
+        self.setFlags(FLAG_MARKER, flag)
 
     def setPipeFlag(self, flag):
         '''
@@ -521,7 +1194,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_PIPE_FLAG] = flag
+        self.setFlags(FLAG_PIPE, flag)
 
     def setRunFlag(self, flag):
         '''
@@ -537,7 +1210,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_RUN_FLAG] = flag
+        self.setFlags(FLAG_RUN, flag)
 
     def setExitFlag(self, flag):
         '''
@@ -553,7 +1226,7 @@ class SHMCAM:
             Raises:
                 None
         '''
-        self._shm[INDEX_EXIT_FLAG] = flag
+        self.setFlags(FLAG_EXIT, flag)
 
     def close(self):
         '''
@@ -568,6 +1241,15 @@ class SHMCAM:
             Raises:
                 None
         '''
+        # views on the buffer need to be released before closing
+        self._header = None
+        self._slots = None
+        self._frames = None
+        self._planes = None
+        self._boxes = None
+        self._futex = None
+        self._headerTimes = None
+        self._shmImage.close()
         self._shm.shm.close()
 
     def unlink(self):
@@ -583,4 +1265,5 @@ class SHMCAM:
             Raises:
                 None
         '''
+        self._shmImage.unlink()
         self._shm.shm.unlink()
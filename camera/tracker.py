@@ -0,0 +1,311 @@
+# TheBlackmad
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+# Kalman filter of SORT (https://github.com/abewley/sort). The state of a
+# track is [u, v, s, r, du, dv, ds]: center, area and aspect ratio of the box,
+# and the velocity of the center and the area (the aspect ratio is constant).
+# The measurement is [u, v, s, r].
+KALMAN_H = np.eye(4, 7)
+KALMAN_R = np.diag([1.0, 1.0, 10.0, 10.0])
+KALMAN_P0 = np.diag([10.0, 10.0, 10.0, 10.0, 10000.0, 10000.0, 10000.0])
+KALMAN_Q = np.diag([1.0, 1.0, 1.0, 1.0, 0.01, 0.01, 0.0001])
+
+
+def toMeasurement(boxes):
+    '''
+        This routine converts boxes [x, y, w, h] to measurements [u, v, s, r].
+
+        Args:
+            boxes (ndarray): boxes (n, 4), x and y of the top left corner
+
+        Returns:
+            ndarray (n, 4)
+
+        Raises:
+            None
+    '''
+    w = np.maximum(boxes[:, 2], 1.0)
+    h = np.maximum(boxes[:, 3], 1.0)
+    return np.stack((boxes[:, 0] + w / 2, boxes[:, 1] + h / 2, w * h, w / h), axis=-1)
+
+
+def toBoxes(states):
+    '''
+        This routine converts states [u, v, s, r, ...] to boxes [x, y, w, h].
+
+        Args:
+            states (ndarray): states (n, 7)
+
+        Returns:
+            ndarray (n, 4), x and y of the top left corner
+
+        Raises:
+            None
+    '''
+    w = np.sqrt(np.maximum(states[:, 2] * states[:, 3], 0.0))
+    h = np.where(w > 0, states[:, 2] / np.maximum(w, 1e-6), 0.0)
+    return np.stack((states[:, 0] - w / 2, states[:, 1] - h / 2, w, h), axis=-1)
+
+
+def iouMatrix(a, b):
+    '''
+        This routine calculates the intersection over union of every box of a
+        with every box of b.
+
+        Args:
+            a (ndarray): boxes (n, 4) as x, y, w, h
+            b (ndarray): boxes (m, 4) as x, y, w, h
+
+        Returns:
+            ndarray (n, m)
+
+        Raises:
+            None
+    '''
+    ax1, ay1 = a[:, 0:1], a[:, 1:2]
+    ax2, ay2 = ax1 + a[:, 2:3], ay1 + a[:, 3:4]
+    bx1, by1 = b[:, 0], b[:, 1]
+    bx2, by2 = bx1 + b[:, 2], by1 + b[:, 3]
+    w = np.maximum(0.0, np.minimum(ax2, bx2) - np.maximum(ax1, bx1))
+    h = np.maximum(0.0, np.minimum(ay2, by2) - np.maximum(ay1, by1))
+    inter = w * h
+    union = a[:, 2:3] * a[:, 3:4] + b[:, 2] * b[:, 3] - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+class Tracker:
+    '''
+        This class follows the objects detected from frame to frame (SORT: a
+        Kalman filter per object and matching by intersection over union), so
+        that each object keeps the same track id. Between detections the
+        boxes are predicted, and an object missed by a detection is kept for
+        maxAge frames. All the tracks are filtered at once with NumPy.
+    '''
+
+    def __init__(self, iouThreshold=0.3, maxAge=15, minHits=1):
+        '''
+            This routine initializes the tracker.
+
+            Args:
+                iouThreshold (float): minimum intersection over union to match a
+                    detection with a track
+                maxAge (int): frames a track is kept without detections
+                minHits (int): detections needed before a track is returned
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        self.iouThreshold = iouThreshold
+        self.maxAge = maxAge
+        self.minHits = minHits
+        self.nextId = 1
+        self.lastSeq = None
+
+        # state of the tracks, one row per track
+        self._x = np.zeros((0, 7))
+        self._p = np.zeros((0, 7, 7))
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._classes = np.zeros(0, dtype=np.int64)
+        self._hits = np.zeros(0, dtype=np.int64)
+        self._missed = np.zeros(0, dtype=np.int64)
+        self._info = []
+
+    def _predict(self, seq):
+        '''
+            This routine moves all the tracks to the frame given.
+
+            Args:
+                seq (int): sequence number of the frame
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        # a detection arriving late (pipelined detector) does not move the
+        # tracks back, it updates them where they are
+        steps = 1 if self.lastSeq is None else max(seq - self.lastSeq, 0)
+        self.lastSeq = seq if self.lastSeq is None else max(self.lastSeq, seq)
+        if steps == 0 or len(self._x) == 0:
+            return
+
+        f = np.eye(7)
+        f[0, 4] = f[1, 5] = f[2, 6] = steps
+
+        # the area cannot shrink below zero
+        shrinking = self._x[:, 2] + steps * self._x[:, 6] <= 0
+        self._x[shrinking, 6] = 0.0
+
+        self._x = self._x @ f.T
+        self._p = f @ self._p @ f.T + KALMAN_Q * steps
+        self._missed += steps
+
+    def _match(self, boxes, classes):
+        '''
+            This routine matches the detections with the tracks of the same
+            class, greedily from the highest intersection over union.
+
+            Args:
+                boxes (ndarray): boxes (m, 4) of the detections
+                classes (ndarray): class of each detection
+
+            Returns:
+                list of pairs (track, detection)
+
+            Raises:
+                None
+        '''
+        if len(self._x) == 0 or len(boxes) == 0:
+            return []
+        iou = iouMatrix(toBoxes(self._x), boxes)
+        iou[self._classes[:, None] != classes[None, :]] = 0.0
+
+        tracks, detections = np.nonzero(iou >= self.iouThreshold)
+        order = np.argsort(-iou[tracks, detections])
+        pairs = []
+        usedTracks, usedDetections = set(), set()
+        for t, d in zip(tracks[order], detections[order]):
+            if t not in usedTracks and d not in usedDetections:
+                usedTracks.add(t)
+                usedDetections.add(d)
+                pairs.append((t, d))
+        return pairs
+
+    def predict(self, seq):
+        '''
+            This routine gets the tracks predicted on a frame without
+            detection.
+
+            Args:
+                seq (int): sequence number of the frame
+
+            Returns:
+                list of boxes, as returned by update()
+
+            Raises:
+                None
+        '''
+        self._predict(seq)
+        self._prune()
+        return self._output()
+
+    def update(self, boxes, seq):
+        '''
+            This routine updates the tracks with the detections of a frame.
+
+            Args:
+                boxes (list): detections in the form [ [x, y, w, h], label,
+                    confidence, color, class_id ] (see YOLO_Detector.detect())
+                seq (int): sequence number of the frame
+
+            Returns:
+                list of boxes in the form [ [x, y, w, h], label, confidence,
+                color, class_id, track_id ]
+
+            Raises:
+                None
+        '''
+        self._predict(seq)
+
+        z = np.array([b[0] for b in boxes], dtype=np.float64).reshape(-1, 4)
+        classes = np.array([b[4] if len(b) > 4 else -1 for b in boxes], dtype=np.int64)
+        pairs = self._match(z, classes)
+
+        # Kalman update of the tracks matched, all at once
+        if pairs:
+            t = np.array([p[0] for p in pairs])
+            d = np.array([p[1] for p in pairs])
+            p = self._p[t]
+            y = toMeasurement(z[d]) - self._x[t, :4]
+            s = p[:, :4, :4] + KALMAN_R
+            k = p[:, :, :4] @ np.linalg.inv(s)
+            self._x[t] += (k @ y[..., None])[..., 0]
+            self._p[t] = (np.eye(7) - k @ KALMAN_H) @ p
+            self._hits[t] += 1
+            self._missed[t] = 0
+            for i, j in pairs:
+                self._info[i] = boxes[j][1:4]
+
+        # new tracks for the detections not matched
+        matched = set(p[1] for p in pairs)
+        new = [j for j in range(len(boxes)) if j not in matched]
+        if new:
+            x = np.zeros((len(new), 7))
+            x[:, :4] = toMeasurement(z[new])
+            self._x = np.concatenate((self._x, x))
+            self._p = np.concatenate((self._p, np.repeat(KALMAN_P0[None], len(new), axis=0)))
+            self._ids = np.concatenate((self._ids, np.arange(self.nextId, self.nextId + len(new))))
+            self._classes = np.concatenate((self._classes, classes[new]))
+            self._hits = np.concatenate((self._hits, np.ones(len(new), dtype=np.int64)))
+            self._missed = np.concatenate((self._missed, np.zeros(len(new), dtype=np.int64)))
+            self._info.extend(boxes[j][1:4] for j in new)
+            self.nextId += len(new)
+
+        self._prune()
+        return self._output()
+
+    def _prune(self):
+        '''
+            This routine removes the tracks without detections for more than
+            maxAge frames.
+
+            Args:
+                None
+
+            Returns:
+                None
+
+            Raises:
+                None
+        '''
+        keep = self._missed <= self.maxAge
+        if keep.all():
+            return
+        self._x = self._x[keep]
+        self._p = self._p[keep]
+        self._ids = self._ids[keep]
+        self._classes = self._classes[keep]
+        self._hits = self._hits[keep]
+        self._missed = self._missed[keep]
+        self._info = [info for info, k in zip(self._info, keep) if k]
+
+    def _output(self):
+        '''
+            This routine gets the boxes of the tracks with minHits detections.
+
+            Args:
+                None
+
+            Returns:
+                list of boxes, as returned by update()
+
+            Raises:
+                None
+        '''
+        ret = []
+        boxes = toBoxes(self._x)
+        for i in np.nonzero(self._hits >= self.minHits)[0]:
+            x, y, w, h = boxes[i]
+            if w <= 0 or h <= 0:
+                continue
+            label, confidence, color = self._info[i]
+            ret.append([[round(x), round(y), round(w), round(h)], label, confidence, color,
+                        int(self._classes[i]), int(self._ids[i])])
+        return ret